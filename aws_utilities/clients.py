@@ -0,0 +1,41 @@
+"""Shared boto3 sessions, clients and engines.
+
+Creating a session loads credentials and creating a client loads its service model and opens its own connection
+pool, so the tools create one session per profile and one client per service and profile and reuse them for every
+call. Clients are thread safe, and their pools hold as many connections as the eventlet engine makes calls at once,
+so concurrent calls reuse connections rather than each paying for a new TCP and TLS handshake. The engines' clients
+leave retrying to the engine (see aws_utilities.concurrency), so they are kept apart from the clients the tools call
+directly. Every client is registered with aws_utilities.metrics.
+"""
+import functools
+
+import boto3.session
+import botocore.config
+
+from aws_utilities import concurrency
+from aws_utilities import metrics
+
+
+CONFIG = botocore.config.Config(max_pool_connections=concurrency.MAX_CONCURRENCY)
+ENGINE_CONFIG = CONFIG.merge(botocore.config.Config(retries=concurrency.CLIENT_RETRIES))
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(profile=None):
+    return boto3.session.Session(profile_name=profile)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(service, profile=None, config=CONFIG):
+    client = get_session(profile).client(service, config=config)
+    metrics.METRICS.register(client)
+    return client
+
+
+def get_engine(service, use_asyncio=False, profile=None):
+    """Return an engine to run request generators for service on."""
+    if use_asyncio:
+        engine = concurrency.AsyncioEngine(service, profile)
+        metrics.METRICS.register(engine.client)
+        return engine
+    return concurrency.EventletEngine(get_client(service, profile, ENGINE_CONFIG))
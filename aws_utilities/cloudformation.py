@@ -0,0 +1,372 @@
+"""A small data layer over the CloudFormation API.
+
+The functions named *_requests are request generators (see aws_utilities.concurrency) which are run on an engine
+from aws_utilities.clients. Responses are turned into namedtuple records. Unlike boto3 resources, reading an
+attribute of a record never makes an API call.
+"""
+import collections
+import logging
+
+import botocore.exceptions
+
+
+STACK_TYPE = "AWS::CloudFormation::Stack"
+
+LOG = logging.getLogger(__name__)
+
+
+Stack = collections.namedtuple(
+    "Stack",
+    (
+        "stack_id",
+        "stack_name",
+        "stack_status",
+        "parent_id",
+        "root_id",
+        "creation_time",
+        "last_updated_time",
+    ),
+)
+
+StackEvent = collections.namedtuple(
+    "StackEvent",
+    (
+        "id",
+        "timestamp",
+        "stack_id",
+        "stack_name",
+        "resource_type",
+        "logical_resource_id",
+        "physical_resource_id",
+        "resource_status",
+        "resource_status_reason",
+    ),
+)
+
+StackResource = collections.namedtuple(
+    "StackResource",
+    (
+        "stack_id",
+        "logical_resource_id",
+        "physical_resource_id",
+        "resource_type",
+        "resource_status",
+        "resource_status_reason",
+        "last_updated_timestamp",
+    ),
+)
+
+
+def stack_from_response(stack):
+    return Stack(
+        stack["StackId"],
+        stack["StackName"],
+        stack["StackStatus"],
+        stack.get("ParentId"),
+        stack.get("RootId"),
+        stack["CreationTime"],
+        stack.get("LastUpdatedTime"),
+    )
+
+
+def event_from_response(event):
+    return StackEvent(
+        event["EventId"],
+        event["Timestamp"],
+        event["StackId"],
+        event["StackName"],
+        event.get("ResourceType"),
+        event.get("LogicalResourceId"),
+        event.get("PhysicalResourceId", ""),
+        event.get("ResourceStatus"),
+        event.get("ResourceStatusReason"),
+    )
+
+
+def describe_stack_requests(stack_name_or_arn):
+    response = yield "describe_stacks", {"StackName": stack_name_or_arn}
+    return stack_from_response(response["Stacks"][0])
+
+
+def stack_events_page_requests(stack_id, next_token=None):
+    """Read one page of a stack's events, newest first. Returns the events and the token for the next page."""
+    kwargs = {"StackName": stack_id}
+    if next_token:
+        kwargs["NextToken"] = next_token
+    response = yield "describe_stack_events", kwargs
+    return (
+        [event_from_response(event) for event in response["StackEvents"]],
+        response.get("NextToken"),
+    )
+
+
+class StackCursor(object):
+    """Remembers the newest event seen for a stack so that each poll only fetches the events after it.
+
+    DescribeStackEvents returns the newest events first, so paging stops as soon as the remembered event shows up. A
+    poll of a stack with no new events costs a single page.
+    """
+
+    def __init__(self, stack_id):
+        self.stack_id = stack_id
+        self.last_event_id = None
+
+    def poll_requests(self):
+        """Return the stack's new events, oldest first, or None if they couldn't be read.
+
+        The first poll returns the first page of events.
+        """
+        new_events = []
+        next_token = None
+        while True:
+            try:
+                page, next_token = yield from stack_events_page_requests(
+                    self.stack_id, next_token
+                )
+            except botocore.exceptions.ClientError:
+                if not new_events and self.last_event_id is None:
+                    return None
+                break
+            found = False
+            for event in page:
+                if event.id == self.last_event_id:
+                    found = True
+                    break
+                new_events.append(event)
+            if found or self.last_event_id is None or not next_token:
+                break
+        if new_events:
+            self.last_event_id = new_events[0].id
+        new_events.reverse()
+        return new_events
+
+
+def list_stack_resources_requests(stack_id):
+    """Return the summaries of every resource directly in a stack."""
+    resources = []
+    kwargs = {"StackName": stack_id}
+    while True:
+        response = yield "list_stack_resources", dict(kwargs)
+        for summary in response["StackResourceSummaries"]:
+            resources.append(
+                StackResource(
+                    stack_id,
+                    summary["LogicalResourceId"],
+                    summary.get("PhysicalResourceId", ""),
+                    summary["ResourceType"],
+                    summary["ResourceStatus"],
+                    summary.get("ResourceStatusReason"),
+                    summary.get("LastUpdatedTimestamp"),
+                )
+            )
+        if not response.get("NextToken"):
+            return resources
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def list_stacks_requests(statuses):
+    """Return the summary of every stack in one of the given statuses, and the number of pages it took."""
+    stacks = []
+    kwargs = {"StackStatusFilter": statuses}
+    pages = 0
+    while True:
+        response = yield "list_stacks", dict(kwargs)
+        pages += 1
+        stacks.extend(response["StackSummaries"])
+        if not response.get("NextToken"):
+            return stacks, pages
+        kwargs["NextToken"] = response["NextToken"]
+
+
+class StackGraph(object):
+    """An index of which stack each stack in a tree is nested in.
+
+    Edges come from responses the tools read anyway: the nested stack resources found when the tree is listed, the
+    events for nested stack resources, and the ParentId of stack summaries. Each stack's depth below the root is
+    stored as it is attached, so looking it up is O(1), finding its ancestors is O(depth) and finding its subtree is
+    proportional to the size of the subtree. Stacks can be added before their parent is known, in which case they
+    have no depth until the parent is attached.
+    """
+
+    def __init__(self, root_id):
+        self.root_id = root_id
+        self.parents = {}
+        self.children = collections.defaultdict(set)
+        self.depths = {root_id: 0}
+
+    def __contains__(self, stack_id):
+        return stack_id in self.depths
+
+    def __len__(self):
+        return len(self.depths)
+
+    def add(self, stack_id, parent_id):
+        if (
+            not stack_id
+            or not parent_id
+            or stack_id == self.root_id
+            or self.parents.get(stack_id) == parent_id
+        ):
+            return
+        old_parent_id = self.parents.get(stack_id)
+        if old_parent_id is not None:
+            self.children[old_parent_id].discard(stack_id)
+        self.parents[stack_id] = parent_id
+        self.children[parent_id].add(stack_id)
+        if parent_id in self.depths:
+            self._set_depths(stack_id, self.depths[parent_id] + 1)
+
+    def _set_depths(self, stack_id, depth):
+        pending = [(stack_id, depth)]
+        seen = set()
+        while pending:
+            stack_id, depth = pending.pop()
+            if stack_id in seen:
+                continue
+            seen.add(stack_id)
+            self.depths[stack_id] = depth
+            pending.extend(
+                (child, depth + 1) for child in self.children.get(stack_id, ())
+            )
+
+    def add_event(self, event):
+        """Record the stack nested in event's stack if event is for a nested stack resource."""
+        if (
+            event.resource_type == STACK_TYPE
+            and event.physical_resource_id != event.stack_id
+        ):
+            self.add(event.physical_resource_id, event.stack_id)
+
+    def depth(self, stack_id):
+        """Return how far below the root stack_id is, or None if it isn't attached to the root."""
+        return self.depths.get(stack_id)
+
+    def within(self, stack_id, max_depth):
+        """Return whether stack_id is attached to the root no deeper than max_depth (any depth if it is None)."""
+        depth = self.depths.get(stack_id)
+        return depth is not None and (max_depth is None or depth <= max_depth)
+
+    def ancestors(self, stack_id):
+        """Return the ids of the stacks stack_id is nested in, nearest first."""
+        ancestors = []
+        stack_id = self.parents.get(stack_id)
+        while stack_id is not None and stack_id not in ancestors:
+            ancestors.append(stack_id)
+            stack_id = self.parents.get(stack_id)
+        return ancestors
+
+    def subtree(self, stack_id):
+        """Return the ids of stack_id and every stack nested in it, parents before children."""
+        stack_ids = [stack_id]
+        seen = {stack_id}
+        for parent_id in stack_ids:
+            for child in self.children.get(parent_id, ()):
+                if child not in seen:
+                    seen.add(child)
+                    stack_ids.append(child)
+        return stack_ids
+
+
+# Statuses of a stack's own event when an operation on it starts.
+OPERATION_START_STATUSES = (
+    "CREATE_IN_PROGRESS",
+    "UPDATE_IN_PROGRESS",
+    "DELETE_IN_PROGRESS",
+    "IMPORT_IN_PROGRESS",
+)
+
+
+def is_own_event(event):
+    """Return whether event is about the stack it belongs to rather than one of its resources."""
+    return (
+        event.resource_type == STACK_TYPE
+        and event.physical_resource_id == event.stack_id
+    )
+
+
+def operation_events_requests(stack_id, since=None):
+    """Return the events of the last operation on a stack, oldest first.
+
+    The operation starts at the stack's last start event, or at since for a stack nested in the one being profiled.
+    """
+    events = []
+    next_token = None
+    while True:
+        try:
+            page, next_token = yield from stack_events_page_requests(
+                stack_id, next_token
+            )
+        except botocore.exceptions.ClientError:
+            break
+        done = False
+        for event in page:
+            if since is not None and event.timestamp < since:
+                done = True
+                break
+            events.append(event)
+            if (
+                since is None
+                and is_own_event(event)
+                and event.resource_status in OPERATION_START_STATUSES
+            ):
+                done = True
+                break
+        if done or not next_token:
+            break
+    events.reverse()
+    return events
+
+
+# How long a resource spent on one status change, from its first *_IN_PROGRESS event to the event which ended it.
+# Resources still in progress end now.
+ResourceSpan = collections.namedtuple(
+    "ResourceSpan",
+    (
+        "stack_id",
+        "stack_name",
+        "logical_resource_id",
+        "physical_resource_id",
+        "resource_type",
+        "resource_status",
+        "start",
+        "end",
+    ),
+)
+
+
+def resource_spans(events, now):
+    spans = []
+    started = collections.OrderedDict()
+    for event in events:
+        if is_own_event(event):
+            continue
+        if event.resource_status.endswith("IN_PROGRESS"):
+            started.setdefault(event.logical_resource_id, event)
+        elif event.logical_resource_id in started:
+            start = started.pop(event.logical_resource_id)
+            spans.append(
+                ResourceSpan(
+                    event.stack_id,
+                    event.stack_name,
+                    event.logical_resource_id,
+                    event.physical_resource_id or start.physical_resource_id,
+                    event.resource_type,
+                    event.resource_status,
+                    start.timestamp,
+                    event.timestamp,
+                )
+            )
+    for start in started.values():
+        spans.append(
+            ResourceSpan(
+                start.stack_id,
+                start.stack_name,
+                start.logical_resource_id,
+                start.physical_resource_id,
+                start.resource_type,
+                start.resource_status,
+                start.timestamp,
+                now,
+            )
+        )
+    return spans
@@ -0,0 +1,421 @@
+"""An adaptive limit on the number of concurrent AWS API calls.
+
+The limit follows AIMD (additive increase, multiplicative decrease). Until the first throttle every successful call
+grows it by one, doubling it each round of calls. After that every successful call grows it by 1/limit, so it goes
+up by about one per round, and a throttled call halves it. Throttled calls are retried by the controller rather than
+by tenacity, so instead of every caller sleeping on its own exponential schedule the whole process backs off
+together and the limit settles near what the account's API quota allows.
+
+API calls are described by generators which yield (operation, kwargs) requests and are sent the responses, so the
+same paging logic can be run on a blocking or an asyncio client with run_requests or run_requests_async.
+
+The engines' clients are created with botocore's own retries turned off, as they would otherwise sleep through
+throttles while holding a slot, and the controller would only see the throttles botocore gave up on. Transport
+errors, such as dropped connections, and the API's server errors are retried up to MAX_ATTEMPTS times by the engines
+with one shared policy and counted in RETRIES. Any other error is raised straight away.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import random
+import sys
+
+import botocore.exceptions
+import eventlet
+import eventlet.event
+import eventlet.greenpool
+import eventlet.queue
+import tenacity
+
+try:
+    import aiobotocore.config
+    import aiobotocore.session
+except ImportError:
+    aiobotocore = None
+
+
+THROTTLING_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+)
+
+LOG = logging.getLogger(__name__)
+
+# The most calls the eventlet engine makes at once. Shared clients keep this many pooled connections.
+MAX_CONCURRENCY = 64
+
+# asyncio tasks are cheap, so the asyncio engine lets the controller go much higher.
+ASYNCIO_MAX_CONCURRENCY = 2048
+
+# The retries config for the engines' clients. Every call is made once and the engine decides whether to retry it.
+CLIENT_RETRIES = {"max_attempts": 0}
+
+# Throttled calls are only slept on once the limit can't be lowered any further.
+MIN_WAIT = 0.1
+MAX_WAIT = 10
+
+# How many times a call which fails with a retryable error is made before the error is raised.
+MAX_ATTEMPTS = 8
+
+# Errors in getting a response from the API, as opposed to errors such as missing credentials or invalid parameters
+# which would only fail again.
+TRANSPORT_ERRORS = (
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.HTTPClientError,
+)
+
+# The number of retried calls by the type of error which was retried.
+RETRIES: "collections.Counter[str]" = collections.Counter()
+
+
+def is_throttling(exc):
+    return (
+        isinstance(exc, botocore.exceptions.ClientError)
+        and exc.response.get("Error", {}).get("Code") in THROTTLING_CODES
+    )
+
+
+def is_server_error(exc):
+    return (
+        isinstance(exc, botocore.exceptions.ClientError)
+        and exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    )
+
+
+def is_retryable(exc):
+    """Retry transport errors and server errors, but not errors such as a stack not existing.
+
+    Throttling is retried by the controller, and a cancelled asyncio call has to stay cancelled.
+    """
+    # CancelledError is only kept out of Exception from Python 3.8.
+    if isinstance(exc, asyncio.CancelledError):
+        return False
+    if isinstance(exc, botocore.exceptions.ClientError):
+        return is_server_error(exc) and not is_throttling(exc)
+    return isinstance(exc, TRANSPORT_ERRORS)
+
+
+def log_retry(retry_state):
+    exc = retry_state.outcome.exception()
+    RETRIES[type(exc).__name__] += 1
+    # The engines' call methods are retried, so the operation follows self.
+    LOG.warning("Retrying %s after %r", retry_state.args[1], exc)
+
+
+retry = tenacity.retry(
+    retry=tenacity.retry_if_exception(is_retryable),
+    wait=tenacity.wait_random_exponential(multiplier=1, min=MIN_WAIT, max=MAX_WAIT),
+    stop=tenacity.stop_after_attempt(MAX_ATTEMPTS),
+    before_sleep=log_retry,
+    reraise=True,
+)
+
+
+class AIMDController(object):
+    """Limits the calls made by eventlet green threads."""
+
+    def __init__(self, initial=4, minimum=1, maximum=MAX_CONCURRENCY):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.peak = 0
+        self.calls = 0
+        self.throttles = 0
+        self._decreases = 0
+        self._waiters = []
+
+    def pool(self):
+        """Return a pool big enough that the controller, not the pool, limits how many calls are made at once."""
+        return eventlet.greenpool.GreenPool(self.maximum)
+
+    def _start(self):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        return self._decreases
+
+    def acquire(self):
+        """Wait for a free slot and return a token to pass to release."""
+        while self.in_flight >= int(self.limit):
+            waiter = eventlet.event.Event()
+            self._waiters.append(waiter)
+            waiter.wait()
+        return self._start()
+
+    def release(self, token, throttled=False):
+        self.in_flight -= 1
+        self.calls += 1
+        if throttled:
+            self.throttles += 1
+            # Calls which were already in flight when the limit was lowered were sent at the old rate, so their
+            # throttles don't lower it again.
+            if token == self._decreases:
+                self._decreases += 1
+                self.limit = max(self.minimum, self.limit / 2)
+        elif self.throttles:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+        self._wake()
+
+    def _notify(self, waiter):
+        waiter.send()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            self._notify(self._waiters.pop(0))
+            free -= 1
+
+    def backoff(self, attempt):
+        """Return how long to wait before retrying a throttled call, or 0 if the lower limit is enough."""
+        if self.limit > self.minimum:
+            return 0
+        return random.uniform(0, min(MAX_WAIT, MIN_WAIT * 2 ** attempt))
+
+    def run(self, func, *args, **kwargs):
+        """Call func in a slot, retrying it for as long as it is throttled."""
+        attempt = 0
+        while True:
+            token = self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                throttled = is_throttling(exc)
+                self.release(token, throttled)
+                if not throttled:
+                    raise
+            else:
+                self.release(token)
+                return result
+            wait = self.backoff(attempt)
+            if wait:
+                eventlet.sleep(wait)
+                attempt += 1
+
+    def format_stats(self):
+        return "concurrency=%d peak_concurrency=%d api_calls=%d api_throttles=%d" % (
+            int(self.limit),
+            self.peak,
+            self.calls,
+            self.throttles,
+        )
+
+
+class AsyncAIMDController(AIMDController):
+    """Limits the calls made by asyncio tasks."""
+
+    def _notify(self, waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        return self._start()
+
+    async def run(self, func, *args, **kwargs):
+        """Await func in a slot, retrying it for as long as it is throttled."""
+        attempt = 0
+        while True:
+            token = await self.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                self.release(token)
+                raise
+            except Exception as exc:
+                throttled = is_throttling(exc)
+                self.release(token, throttled)
+                if not throttled:
+                    raise
+            else:
+                self.release(token)
+                return result
+            wait = self.backoff(attempt)
+            if wait:
+                await asyncio.sleep(wait)
+                attempt += 1
+
+
+def run_requests(requests, call):
+    """Run a generator of (operation, kwargs) requests with call(operation, **kwargs) and return its result.
+
+    Responses are sent back into the generator and errors are thrown into it.
+    """
+    try:
+        operation, kwargs = next(requests)
+        while True:
+            try:
+                response = call(operation, **kwargs)
+            except Exception as exc:
+                operation, kwargs = requests.throw(exc)
+            else:
+                operation, kwargs = requests.send(response)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_requests_async(requests, call):
+    """run_requests for an async call."""
+    try:
+        operation, kwargs = next(requests)
+        while True:
+            try:
+                response = await call(operation, **kwargs)
+            except Exception as exc:
+                operation, kwargs = requests.throw(exc)
+            else:
+                operation, kwargs = requests.send(response)
+    except StopIteration as stop:
+        return stop.value
+
+
+class EventletEngine(object):
+    """Runs requests with a blocking boto3 client in green threads, limited by controller."""
+
+    def __init__(self, client, controller=None):
+        self.client = client
+        self.controller = controller or AIMDController()
+        self.api_calls = collections.Counter()
+
+    @retry
+    def call(self, operation, **kwargs):
+        def make_call():
+            self.api_calls[operation] += 1
+            return getattr(self.client, operation)(**kwargs)
+
+        return self.controller.run(make_call)
+
+    def run(self, requests):
+        return run_requests(requests, self.call)
+
+    def map(self, requests_func, items):
+        """Run requests_func(item) for every item concurrently and return the results in order."""
+        return list(
+            self.controller.pool().imap(
+                lambda item: self.run(requests_func(item)), items
+            )
+        )
+
+    def traverse(self, requests_func, roots, children):
+        """Run requests_func(item) for each root and each item children(item, result) returns, concurrently.
+
+        Each item is started as soon as it is known rather than a level at a time. Yields (item, result) pairs in the
+        order they finish.
+        """
+        pool = self.controller.pool()
+        finished = eventlet.queue.LightQueue()
+
+        def run(item):
+            try:
+                finished.put((item, self.run(requests_func(item)), None))
+            except Exception as exc:
+                finished.put((item, None, exc))
+
+        running = 0
+        for item in roots:
+            pool.spawn_n(run, item)
+            running += 1
+        while running:
+            item, result, exc = finished.get()
+            running -= 1
+            if exc is not None:
+                raise exc
+            for child in children(item, result):
+                pool.spawn_n(run, child)
+                running += 1
+            yield item, result
+
+    def close(self):
+        pass
+
+
+class AsyncioEngine(object):
+    """Runs requests with an aiobotocore client on an event loop owned by the engine.
+
+    The tools' loops stay synchronous. Each run or map runs the loop until its requests are done, and a map can have
+    as many requests in flight as the controller allows.
+    """
+
+    def __init__(self, service, profile=None, maximum=ASYNCIO_MAX_CONCURRENCY):
+        if aiobotocore is None:
+            sys.exit(
+                "The asyncio engine needs aiobotocore, which is installed with pip install aws-utilities[asyncio]"
+            )
+        self.controller = AsyncAIMDController(maximum=maximum)
+        self.api_calls = collections.Counter()
+        self.loop = asyncio.new_event_loop()
+        self._exit_stack = contextlib.AsyncExitStack()
+        session = aiobotocore.session.AioSession(profile=profile)
+        self.client = self.loop.run_until_complete(
+            self._exit_stack.enter_async_context(
+                session.create_client(
+                    service,
+                    config=aiobotocore.config.AioConfig(
+                        max_pool_connections=maximum, retries=CLIENT_RETRIES
+                    ),
+                )
+            )
+        )
+
+    @retry
+    async def call(self, operation, **kwargs):
+        async def make_call():
+            self.api_calls[operation] += 1
+            return await getattr(self.client, operation)(**kwargs)
+
+        return await self.controller.run(make_call)
+
+    def run(self, requests):
+        return self.loop.run_until_complete(run_requests_async(requests, self.call))
+
+    def map(self, requests_func, items):
+        """Run requests_func(item) for every item concurrently and return the results in order."""
+
+        async def run_all():
+            return await asyncio.gather(
+                *(run_requests_async(requests_func(item), self.call) for item in items)
+            )
+
+        return self.loop.run_until_complete(run_all())
+
+    def traverse(self, requests_func, roots, children):
+        """EventletEngine.traverse on the event loop, which only runs while waiting for the next item to finish."""
+        tasks = {}
+
+        def start(item):
+            task = self.loop.create_task(
+                run_requests_async(requests_func(item), self.call)
+            )
+            tasks[task] = item
+
+        for item in roots:
+            start(item)
+        try:
+            while tasks:
+                done, _ = self.loop.run_until_complete(
+                    asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                )
+                for task in done:
+                    item = tasks.pop(task)
+                    result = task.result()
+                    for child in children(item, result):
+                        start(child)
+                    yield item, result
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True)
+                )
+
+    def close(self):
+        self.loop.run_until_complete(self._exit_stack.aclose())
+        self.loop.close()
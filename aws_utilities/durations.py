@@ -0,0 +1,204 @@
+"""How long CloudFormation resource changes usually take, learned from the stack events the tools read.
+
+Every resource change which completes is added to a histogram for its resource type and another for its logical ID,
+both under the kind of change (CREATE, UPDATE or DELETE). The buckets of the histograms are log-spaced, so each one
+is a few dozen numbers however much history it holds, and once one holds more than MAX_SAMPLES its counts are halved
+so that recent changes count for more than old ones. The p50 and p95 of every histogram are worked out when the model
+is saved, so an estimate is a dict lookup.
+
+The model is kept in a JSON file, ~/.cache/aws_utilities/durations.json by default. Saving merges what was learned
+since loading into the file as it is at the time, so tools running at the same time don't lose each other's changes.
+"""
+import collections
+import datetime
+import json
+import logging
+import math
+import os
+import tempfile
+
+
+# Each bucket is this much wider than the one before. Quantiles are the middle of their bucket, so within about 12%.
+GROWTH = 1.25
+
+# A histogram's counts are halved when it holds more samples than this.
+MAX_SAMPLES = 200
+
+# Counts which have been halved below this are dropped.
+MIN_COUNT = 0.05
+
+# Estimates need at least this many samples. Logical IDs with fewer fall back to their resource type.
+MIN_SAMPLES = 3
+
+# Changes which finished longer ago than this aren't learned, so the record of how far each stack's events have been
+# learned from only needs to keep stacks which changed within it.
+LEARN_WINDOW = datetime.timedelta(days=30)
+
+LOG = logging.getLogger(__name__)
+
+Estimate = collections.namedtuple("Estimate", ("p50", "p95", "samples"))
+
+
+def default_path():
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "aws_utilities",
+        "durations.json",
+    )
+
+
+def format_duration(delta):
+    seconds = int(delta.total_seconds())
+    if seconds >= 3600:
+        return "%dh%02dm%02ds" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+
+def change_kind(status):
+    """Return the kind of change a resource status belongs to, e.g. UPDATE for UPDATE_IN_PROGRESS."""
+    for suffix in ("_IN_PROGRESS", "_COMPLETE", "_FAILED"):
+        if status.endswith(suffix):
+            return status[: -len(suffix)]
+    return status
+
+
+def model_keys(status, resource_type, logical_resource_id):
+    """Return the keys of a change's histograms, most specific first."""
+    kind = change_kind(status)
+    return (
+        "%s %s %s" % (kind, resource_type, logical_resource_id),
+        "%s %s" % (kind, resource_type),
+    )
+
+
+class Histogram(object):
+    """Counts of durations in log-spaced buckets of seconds."""
+
+    def __init__(self, counts=None):
+        self.counts = {int(index): count for index, count in (counts or {}).items()}
+
+    @property
+    def samples(self):
+        return sum(self.counts.values())
+
+    def add(self, seconds):
+        index = max(0, int(math.floor(math.log(max(seconds, 1), GROWTH))))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        if self.samples > MAX_SAMPLES:
+            self.counts = {
+                index: count / 2.0
+                for index, count in self.counts.items()
+                if count / 2.0 >= MIN_COUNT
+            }
+
+    def quantile(self, q):
+        rank = q * self.samples
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return GROWTH ** (index + 0.5)
+        return 0.0
+
+    def to_json(self):
+        return {
+            "samples": round(self.samples, 2),
+            "p50": round(self.quantile(0.5), 1),
+            "p95": round(self.quantile(0.95), 1),
+            "buckets": {str(index): count for index, count in self.counts.items()},
+        }
+
+
+def empty_data():
+    return {"durations": {}, "learned": {}}
+
+
+class DurationModel(object):
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.data = self._read()
+        # (stack_id, end, keys, seconds) for the changes learned since the model was loaded or saved.
+        self._new = []
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return empty_data()
+        except ValueError:
+            LOG.warning("Ignoring unreadable resource durations in %s", self.path)
+            return empty_data()
+        return data
+
+    def estimate(self, status, resource_type, logical_resource_id):
+        """Return an Estimate of how long a change takes in total, or None if there aren't enough samples."""
+        for key in model_keys(status, resource_type, logical_resource_id):
+            entry = self.data["durations"].get(key)
+            if entry and entry["samples"] >= MIN_SAMPLES:
+                return Estimate(
+                    datetime.timedelta(seconds=entry["p50"]),
+                    datetime.timedelta(seconds=entry["p95"]),
+                    int(round(entry["samples"])),
+                )
+        return None
+
+    def learn(self, spans, now):
+        """Learn the completed changes in spans (cloudformation.ResourceSpan) which haven't been learned yet."""
+        learned = self.data["learned"]
+        oldest = (now - LEARN_WINDOW).timestamp()
+        ends = {}
+        for span in spans:
+            if not span.resource_status.endswith("_COMPLETE"):
+                continue
+            end = span.end.timestamp()
+            if end <= max(oldest, learned.get(span.stack_id, 0)):
+                continue
+            self._new.append(
+                (
+                    span.stack_id,
+                    end,
+                    model_keys(
+                        span.resource_status,
+                        span.resource_type,
+                        span.logical_resource_id,
+                    ),
+                    (span.end - span.start).total_seconds(),
+                )
+            )
+            ends[span.stack_id] = max(end, ends.get(span.stack_id, 0))
+        learned.update(ends)
+
+    def save(self, now):
+        """Merge the changes learned since the last save into the file and reload it."""
+        if not self._new:
+            return
+        data = self._read()
+        learned = dict(data["learned"])
+        histograms = {}
+        for stack_id, end, keys, seconds in self._new:
+            # Another run may have learned these changes already.
+            if end <= learned.get(stack_id, 0):
+                continue
+            for key in keys:
+                if key not in histograms:
+                    histograms[key] = Histogram(
+                        data["durations"].get(key, {}).get("buckets")
+                    )
+                histograms[key].add(seconds)
+            data["learned"][stack_id] = max(end, data["learned"].get(stack_id, 0))
+        for key, histogram in histograms.items():
+            data["durations"][key] = histogram.to_json()
+        oldest = (now - LEARN_WINDOW).timestamp()
+        data["learned"] = {
+            stack_id: end for stack_id, end in data["learned"].items() if end > oldest
+        }
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=directory, prefix=".durations_")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, sort_keys=True)
+        os.replace(path, self.path)
+        self.data = data
+        self._new = []
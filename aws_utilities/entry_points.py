@@ -0,0 +1,38 @@
+"""Entry points which pick how the tools make concurrent API calls before the tools are imported.
+
+The eventlet engine runs blocking boto3 calls in green threads, which needs eventlet.monkey_patch(). The asyncio
+engine (--asyncio) runs aiobotocore calls on an asyncio event loop and needs no patching. Patching has to happen
+before botocore and urllib3 are imported or they keep references to the unpatched socket and ssl classes, so this
+module must only import the standard library and eventlet.
+"""
+import importlib
+import sys
+
+import eventlet
+import eventlet.patcher
+
+
+ASYNCIO_FLAG = "--asyncio"
+
+
+def use_asyncio(argv=None):
+    return ASYNCIO_FLAG in (sys.argv[1:] if argv is None else argv)
+
+
+def setup(argv=None):
+    """Patch the standard library for eventlet unless the asyncio engine was asked for."""
+    if not use_asyncio(argv) and not eventlet.patcher.is_monkey_patched("socket"):
+        eventlet.monkey_patch()
+
+
+def entry_point(module_name):
+    def main():
+        setup()
+        return importlib.import_module(module_name).main()
+
+    return main
+
+
+tail_cloudwatch_logs = entry_point("aws_utilities.tail_cloudwatch_logs")
+tail_stack_events = entry_point("aws_utilities.tail_stack_events")
+pending_stack_resources = entry_point("aws_utilities.pending_stack_resources")
@@ -0,0 +1,324 @@
+"""An on-disk cache of CloudWatch Logs events.
+
+Events are stored per log group in append-only segment files of JSON lines, oldest first. Each segment holds every
+event in the log group within a time range, and the group's index records that range, the streams the segment has
+events for, its size and a sparse index of the offsets of its events by timestamp. Reads use the index to find the
+segments that cover a time range, seek to the first of their events that can be in the range and stop after the last,
+and only the gaps between the segments need to be fetched from AWS. Segments are kept to about SEGMENT_BYTES so that
+when the cache grows past its size budget the least recently read segments can be evicted without losing much else.
+"""
+import bisect
+import json
+import os
+import time
+import urllib.parse
+
+# Events can show up in CloudWatch Logs some time after their timestamp, so only time ranges which ended at least
+# this long ago are cached. Anything newer is always fetched.
+SETTLE_MS = 10 * 60 * 1000
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Events for a time range which directly follows a segment smaller than this are appended to it rather than starting
+# a new segment, which stops repeated runs from leaving lots of tiny segments behind. A segment which grows past it is
+# cut off before the next event with a newer timestamp, and the rest of the events go into a new segment.
+SEGMENT_BYTES = 4 * 1024 * 1024
+
+# How far apart the offsets in a segment's sparse index are, in bytes.
+OFFSET_INDEX_BYTES = 64 * 1024
+
+INDEX_FILE = "index.json"
+
+# The event fields which are worth keeping. log_group and log_stream are added back when reading.
+EVENT_FIELDS = ("eventId", "timestamp", "ingestionTime", "logStreamName", "message")
+
+
+def default_cache_dir():
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "aws_utilities",
+        "logs",
+    )
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class SegmentStore(object):
+    """The cached segments for a single log group."""
+
+    def __init__(self, path, log_group):
+        self.path = path
+        self.log_group = log_group
+        self.segments = []
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.segments = json.load(f)["segments"]
+            self.segments.sort(key=lambda s: s["start"])
+        self._starts = [s["start"] for s in self.segments]
+
+    @property
+    def size(self):
+        return sum(s["bytes"] for s in self.segments)
+
+    @property
+    def oldest(self):
+        return self.segments[0]["start"] if self.segments else None
+
+    def save_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"log_group": self.log_group, "segments": self.segments}, f)
+        os.replace(tmp_path, index_path)
+
+    def overlapping(self, start, end):
+        """Return the segments with events between start and end (inclusive), oldest first."""
+        i = max(0, bisect.bisect_right(self._starts, start) - 1)
+        found = []
+        for segment in self.segments[i:]:
+            if segment["start"] > end:
+                break
+            if segment["end"] >= start:
+                found.append(segment)
+        return found
+
+    def plan(self, start, end):
+        """Split start to end into pieces, oldest first, which are either a cached segment or a gap to fetch.
+
+        Returns a list of (start, end, segment) where segment is None for gaps.
+        """
+        pieces = []
+        position = start
+        for segment in self.overlapping(start, end):
+            if segment["start"] > position:
+                pieces.append((position, segment["start"] - 1, None))
+            pieces.append(
+                (max(position, segment["start"]), min(end, segment["end"]), segment)
+            )
+            position = segment["end"] + 1
+        if position <= end:
+            pieces.append((position, end, None))
+        return pieces
+
+    def read(self, segment, start, end, log_streams=None):
+        if log_streams is not None and not log_streams.intersection(segment["streams"]):
+            return
+        segment["accessed"] = now_ms()
+        # Everything before the last indexed event older than start is older than it too. Segments written before
+        # the offsets were indexed are read from the beginning.
+        offsets = segment.get("offsets", [])
+        i = bisect.bisect_left([timestamp for timestamp, _ in offsets], start)
+        with open(os.path.join(self.path, segment["file"]), "rb") as f:
+            f.seek(offsets[i - 1][1] if i else 0)
+            for line in f:
+                event = json.loads(line)
+                if event["timestamp"] > end:
+                    break
+                if event["timestamp"] < start:
+                    continue
+                if (
+                    log_streams is not None
+                    and event["logStreamName"] not in log_streams
+                ):
+                    continue
+                event["log_group"] = self.log_group
+                event["log_stream"] = event["logStreamName"]
+                yield event
+
+    def _add_segment(self, i, start):
+        segment = {
+            "file": "%d.jsonl" % (start,),
+            "start": start,
+            "streams": [],
+            "offsets": [],
+        }
+        self.segments.insert(i, segment)
+        self._starts.insert(i, start)
+        return segment
+
+    def append(self, start, end, events):
+        """Store events as the complete contents of the log group from start to end (inclusive)."""
+        os.makedirs(self.path, exist_ok=True)
+        events = sorted(events, key=lambda e: e["timestamp"])
+        i = bisect.bisect_right(self._starts, start)
+        previous = self.segments[i - 1] if i else None
+        if (
+            previous is not None
+            and previous["end"] == start - 1
+            and previous["bytes"] < SEGMENT_BYTES
+        ):
+            segment = previous
+            mode = "ab"
+            # Every event in previous is older than these, so it can be cut off before any of them.
+            last_timestamp = previous["end"]
+        else:
+            segment = self._add_segment(i, start)
+            i += 1
+            mode = "wb"
+            last_timestamp = None
+        streams = set(segment["streams"])
+        offsets = segment.setdefault("offsets", [])
+        f = open(os.path.join(self.path, segment["file"]), mode)
+        try:
+            offset = f.tell()
+            indexed = offsets[-1][1] if offsets else 0
+            for event in events:
+                timestamp = event["timestamp"]
+                line = (
+                    json.dumps({k: event[k] for k in EVENT_FIELDS if k in event}) + "\n"
+                ).encode()
+                # Events with the same timestamp stay in the same segment so that each segment is a time range.
+                if (
+                    last_timestamp is not None
+                    and timestamp > last_timestamp
+                    and offset + len(line) > SEGMENT_BYTES
+                ):
+                    segment.update(
+                        end=timestamp - 1,
+                        streams=sorted(streams),
+                        bytes=offset,
+                        accessed=now_ms(),
+                    )
+                    f.close()
+                    segment = self._add_segment(i, timestamp)
+                    i += 1
+                    streams = set()
+                    offsets = segment["offsets"]
+                    f = open(os.path.join(self.path, segment["file"]), "wb")
+                    offset = indexed = 0
+                if offset - indexed >= OFFSET_INDEX_BYTES:
+                    offsets.append([timestamp, offset])
+                    indexed = offset
+                f.write(line)
+                offset += len(line)
+                last_timestamp = timestamp
+                streams.add(event["logStreamName"])
+        finally:
+            f.close()
+        segment.update(
+            end=end, streams=sorted(streams), bytes=offset, accessed=now_ms()
+        )
+        self.save_index()
+        return segment
+
+    def remove(self, segment):
+        i = self.segments.index(segment)
+        del self.segments[i]
+        del self._starts[i]
+        try:
+            os.remove(os.path.join(self.path, segment["file"]))
+        except FileNotFoundError:
+            pass
+
+
+class LogCache(object):
+    def __init__(self, root=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root or default_cache_dir()
+        self.max_bytes = max_bytes
+        self._stores = {}
+
+    def store(self, log_group):
+        if log_group not in self._stores:
+            self._stores[log_group] = SegmentStore(
+                os.path.join(self.root, urllib.parse.quote(log_group, safe="")),
+                log_group,
+            )
+        return self._stores[log_group]
+
+    def all_stores(self):
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if os.path.exists(os.path.join(self.root, name, INDEX_FILE)):
+                    self.store(urllib.parse.unquote(name))
+        return list(self._stores.values())
+
+    def evict(self):
+        """Remove the least recently read segments until the cache fits in its size budget."""
+        stores = self.all_stores()
+        total = sum(store.size for store in stores)
+        if total <= self.max_bytes:
+            return
+        segments = sorted(
+            (
+                (segment["accessed"], segment, store)
+                for store in stores
+                for segment in store.segments
+            ),
+            key=lambda s: s[0],
+        )
+        changed = set()
+        for _, segment, store in segments:
+            if total <= self.max_bytes:
+                break
+            total -= segment["bytes"]
+            store.remove(segment)
+            changed.add(store)
+        for store in changed:
+            store.save_index()
+
+    def covers(self, log_group, start, end):
+        """Return whether every event in log_group from start to end (inclusive) is cached."""
+        return all(
+            segment is not None
+            for _, _, segment in self.store(log_group).plan(start, end)
+        )
+
+    def add(self, log_group, start, end, events):
+        """Cache events which were read as the complete contents of log_group from start to end (inclusive).
+
+        Only the parts of the range which have settled and aren't cached yet are stored.
+        """
+        store = self.store(log_group)
+        for piece_start, piece_end, segment in store.plan(
+            start, min(end, now_ms() - SETTLE_MS)
+        ):
+            if segment is None:
+                store.append(
+                    piece_start,
+                    piece_end,
+                    [e for e in events if piece_start <= e["timestamp"] <= piece_end],
+                )
+
+    def events_requests(
+        self, fetch_requests, log_group, start, end=None, offline=False
+    ):
+        """Return the events in log_group from start to end (inclusive), oldest first.
+
+        This is a request generator (see aws_utilities.concurrency). Cached segments are read from disk. Gaps between
+        them are read with the request generator fetch_requests(log_group, start, end) unless offline is set, and the
+        parts of them which have settled are added to the cache. If end is None the last fetch is left open-ended.
+        """
+        store = self.store(log_group)
+        current = now_ms()
+        open_ended = end is None
+        if open_ended:
+            end = current
+        settled = current - SETTLE_MS
+        accessed = False
+        events = []
+        for piece_start, piece_end, segment in store.plan(start, end):
+            if segment is not None:
+                accessed = True
+                events.extend(store.read(segment, piece_start, piece_end))
+                continue
+            if offline:
+                continue
+            if piece_start <= settled:
+                cache_end = min(piece_end, settled)
+                fetched = yield from fetch_requests(log_group, piece_start, cache_end)
+                store.append(piece_start, cache_end, fetched)
+                events.extend(fetched)
+                piece_start = cache_end + 1
+            if piece_start <= piece_end:
+                if open_ended and piece_end == end:
+                    piece_end = None
+                events.extend(
+                    (yield from fetch_requests(log_group, piece_start, piece_end))
+                )
+        if accessed:
+            store.save_index()
+        return events
@@ -0,0 +1,218 @@
+"""Per-operation API metrics collected from botocore's event hooks.
+
+Every client from aws_utilities.clients is registered with METRICS. The before-call and after-call events time each
+call, including botocore's own retries, and count the bytes received. needs-retry is emitted after every attempt, so
+it also sees the throttles of clients which botocore retries internally rather than the concurrency controller.
+
+The metrics can be printed as a summary with --stats or written in the Prometheus text format with
+--prometheus-file, for node_exporter's textfile collector to pick up from long-running followers.
+"""
+import atexit
+import collections
+import os
+import sys
+import tempfile
+import time
+
+from aws_utilities import concurrency
+
+
+# The upper bounds of the latency histogram's buckets, in seconds.
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# How often the Prometheus file is rewritten while calls are being made.
+PROMETHEUS_INTERVAL = 15
+
+PREFIX = "aws_utilities_api"
+
+# Where before-call leaves the operation and start time in the request context for the events which follow it.
+START_KEY = "aws_utilities_start"
+
+
+class OperationMetrics(object):
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.throttles = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        # One count per bucket plus one for calls slower than the last bucket.
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.latency_sum += seconds
+        self.latency_max = max(self.latency_max, seconds)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the q quantile of latencies."""
+        rank = q * sum(self.buckets)
+        seen = 0
+        for i, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if seen >= rank:
+                return min(LATENCY_BUCKETS[i], self.latency_max)
+        return self.latency_max
+
+
+def operation_key(model):
+    return model.service_model.service_name, model.name
+
+
+class Metrics(object):
+    """Collects metrics for every call made by the clients registered with it."""
+
+    def __init__(self):
+        self.operations = collections.defaultdict(OperationMetrics)
+        self.prometheus_file = None
+        self._last_write = 0
+
+    def register(self, client):
+        events = client.meta.events
+        events.register("before-call", self._before_call)
+        events.register("after-call", self._after_call)
+        events.register("after-call-error", self._after_call_error)
+        events.register("needs-retry", self._needs_retry)
+
+    def _before_call(self, model, context, **kwargs):
+        context[START_KEY] = operation_key(model), time.time()
+
+    def _finish_call(self, context):
+        """Record a finished call. Returns its OperationMetrics, or None if _before_call didn't see it start."""
+        # Another before-call handler, such as botocore's Stubber, can answer the call before ours runs.
+        started = context.pop(START_KEY, None)
+        if started is None:
+            return None
+        key, start = started
+        metrics = self.operations[key]
+        metrics.calls += 1
+        metrics.observe(time.time() - start)
+        if (
+            self.prometheus_file
+            and time.time() - self._last_write >= PROMETHEUS_INTERVAL
+        ):
+            self.write_prometheus()
+        return metrics
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        metrics = self._finish_call(context)
+        if metrics is None:
+            return
+        # aiobotocore's responses read their content asynchronously, so use the header.
+        metrics.bytes += int(http_response.headers.get("Content-Length") or 0)
+        metrics.retries += parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if "Error" in parsed:
+            metrics.errors += 1
+
+    def _after_call_error(self, context, **kwargs):
+        metrics = self._finish_call(context)
+        if metrics is not None:
+            metrics.errors += 1
+
+    def _needs_retry(self, response, operation, **kwargs):
+        if response is None:
+            return
+        code = response[1].get("Error", {}).get("Code")
+        if code in concurrency.THROTTLING_CODES:
+            self.operations[operation_key(operation)].throttles += 1
+
+    def format_stats(self):
+        """Return a line per operation, slowest in total first."""
+        lines = []
+        for (service, operation), metrics in sorted(
+            self.operations.items(), key=lambda item: -item[1].latency_sum
+        ):
+            lines.append(
+                "api: %s.%s calls=%d retries=%d throttles=%d errors=%d bytes=%d "
+                "latency_total=%.2fs latency_p50=%.3fs latency_p95=%.3fs latency_max=%.3fs"
+                % (
+                    service,
+                    operation,
+                    metrics.calls,
+                    metrics.retries,
+                    metrics.throttles,
+                    metrics.errors,
+                    metrics.bytes,
+                    metrics.latency_sum,
+                    metrics.quantile(0.5),
+                    metrics.quantile(0.95),
+                    metrics.latency_max,
+                )
+            )
+        return "\n".join(lines)
+
+    def format_prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text, value_func):
+            lines.append("# HELP %s_%s %s" % (PREFIX, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (PREFIX, name, kind))
+            for (service, operation), metrics in sorted(self.operations.items()):
+                labels = 'service="%s",operation="%s"' % (service, operation)
+                for suffix, extra_labels, value in value_func(metrics):
+                    lines.append(
+                        "%s_%s%s{%s%s} %s"
+                        % (PREFIX, name, suffix, labels, extra_labels, value)
+                    )
+
+        for name, help_text in (
+            ("calls", "API calls made, including those which failed."),
+            ("retries", "Attempts retried by botocore."),
+            ("throttles", "Attempts which were throttled."),
+            ("errors", "API calls which failed."),
+            ("bytes", "Bytes received in responses."),
+        ):
+            metric(
+                name + "_total",
+                "counter",
+                help_text,
+                lambda metrics, name=name: [("", "", getattr(metrics, name))],
+            )
+
+        def histogram(metrics):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                cumulative += count
+                yield "_bucket", ',le="%s"' % (bound,), cumulative
+            yield "_bucket", ',le="+Inf"', cumulative + metrics.buckets[-1]
+            yield "_sum", "", "%.6f" % (metrics.latency_sum,)
+            yield "_count", "", sum(metrics.buckets)
+
+        metric(
+            "call_duration_seconds",
+            "histogram",
+            "API call latency including retries.",
+            histogram,
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """Replace the Prometheus file, so the collector never reads a partly written one."""
+        self._last_write = time.time()
+        directory = os.path.dirname(os.path.abspath(self.prometheus_file))
+        fd, path = tempfile.mkstemp(dir=directory, prefix=".aws_utilities_")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.format_prometheus())
+        os.chmod(path, 0o644)
+        os.replace(path, self.prometheus_file)
+
+
+METRICS = Metrics()
+
+
+def print_stats(out=None):
+    if METRICS.operations:
+        print(METRICS.format_stats(), file=out or sys.stderr)
+
+
+def setup(prometheus_file=None):
+    """Write the Prometheus file while calls are made and on exit."""
+    if prometheus_file:
+        METRICS.prometheus_file = prometheus_file
+        atexit.register(METRICS.write_prometheus)
@@ -1,129 +1,53 @@
 #!/usr/bin/env python
 """Usage:
-    tail_stack_events.py [--depth=<d>] [--max-column-length=<x>] [--profile=<profile>] <stack>
+    tail_stack_events.py [--depth=<d>] [--max-column-length=<x>] [--profile=<profile>] [--asyncio] [--stats] [--prometheus-file=<path>] [--watch] [--interval=<s>] [--durations-file=<path>] [--no-durations] <stack>
 
 Options:
     -p <p> --profile=<profile>      The aws profile to use.
     -d <d> --depth=<d>              The maximum depth to get events for. Use -1 for unlimited depth. [default: 2]
     -x <x> --max-col-length=<x>     The maximum columns length for tabular output.
                                     Defaults to 200 for postmortem, 40 otherwise.
+    --asyncio                       Make API calls with aiobotocore on an asyncio event loop instead of with eventlet.
+    --stats                         Print the API concurrency and the calls, retries, throttles, bytes and latency of
+                                    each API operation to stderr on exit.
+    --prometheus-file=<path>        Write the API metrics to this file in the Prometheus text format.
+    -w --watch                      Keep the table on screen and update it as the stacks' events arrive, redrawing
+                                    only the rows which change.
+    --interval=<s>                  How often --watch polls the pending stacks for new events. [default: 10]
+    --durations-file=<path>         Where the durations of past resource changes are kept.
+                                    Defaults to ~/.cache/aws_utilities/durations.json.
+    --no-durations                  Don't read the stacks' events to time the pending resources and learn how long
+                                    resource changes take.
     <stack>                         The top-level stack to get events for.
 """
 import collections
+import datetime
 import logging
-import math
 import sys
+import time
+import traceback
 
-import eventlet
+if __name__ == "__main__":
+    # Running the script directly rather than through its console script, so patch before botocore is imported.
+    from aws_utilities import entry_points
 
-eventlet.monkey_patch()
+    entry_points.setup()
 
-import ansiwrap
-import botocore.exceptions
-import boto3
-import colorama
 import docopt
-import eventlet.greenpool
-import tenacity
-
-
-STACK_TYPE = "AWS::CloudFormation::Stack"
-ELLIPSIS = u"\u2026"
-
-LOG = logging.getLogger(__name__)
-
-
-def retry(func):
-    tretry = tenacity.retry(
-        wait=(tenacity.wait_random_exponential(multiplier=1, min=0.1, max=10)),
-        after=tenacity.after_log(LOG, logging.WARNING),
-    )
-
-    def log_exc(*a, **k):
-        try:
-            return func(*a, **k)
-        except Exception:
-            LOG.exception("Exception calling %r" % (func,))
-            raise
-
-    return tretry(log_exc)
 
+from aws_utilities import clients
+from aws_utilities import cloudformation
+from aws_utilities import durations
+from aws_utilities import metrics
+from aws_utilities import table as tables
 
-class Column(object):
-    def __init__(self, mvl, ml):
-        self.max_value_length = mvl
-        self.max_length = ml
 
+STACK_TYPE = cloudformation.STACK_TYPE
 
-@retry
-def get_stack(stack_name_or_arn):
-    cf = boto3.resource("cloudformation")
-    stack = cf.Stack(stack_name_or_arn)
-    # Switch to the ARN if a stack name was passed in
-    if stack.stack_id != stack_name_or_arn:
-        stack = cf.Stack(stack.stack_id)
-    return stack
-
-
-def update_columns(columns, events):
-    for event in events:
-        for column in columns.keys():
-            columns[column].max_value_length = max(
-                columns[column].max_value_length, len(str(getattr(event, column)))
-            )
-
-
-def format_column(column_name, column, value):
-    text = str(value)
-    if column_name == "resource_status":
-        uvalue = value.upper()
-        if "FAIL" in uvalue:
-            color = colorama.Fore.RED
-        elif "ROLLBACK" in uvalue:
-            color = colorama.Fore.YELLOW
-        elif "IN_PROGRESS" in uvalue:
-            color = colorama.Fore.BLUE
-        elif uvalue == "DELETE_COMPLETE":
-            color = colorama.Fore.LIGHTBLACK_EX
-        elif "COMPLETE" in uvalue:
-            color = colorama.Fore.GREEN
-        else:
-            color = colorama.Fore.WHITE
-        text = "%s%s%s" % (color, value, colorama.Style.RESET_ALL)
-    if ansiwrap.ansilen(text) > column.max_length:
-        half_length = (column.max_length - 1) / 2.0
-        output_text = "%s%s%s" % (
-            text[: int(math.floor(half_length))],
-            ELLIPSIS,
-            text[-int(math.ceil(half_length)) :],
-        )
-    else:
-        output_text = text
-    padding = " " * max(
-        0,
-        min(column.max_value_length, column.max_length) - ansiwrap.ansilen(output_text),
-    )
-    return "%s%s" % (padding, output_text)
-
-
-def output_events(columns, events):
-    for e in events:
-        fmt = "  ".join("%s" for _ in columns.values())
-        print(
-            fmt
-            % tuple([format_column(n, c, getattr(e, n)) for n, c in columns.items()])
-        )
-
+# The ETA of a change which has been going for longer than the p95 of past changes.
+SLOW = "SLOW"
 
-@retry
-def next_page(pages):
-    try:
-        return list(next(pages))
-    except botocore.exceptions.ClientError:
-        return None
-        # traceback.print_exc()
-    except StopIteration:
-        return None
+LOG = logging.getLogger(__name__)
 
 
 def short_stack_name(name):
@@ -135,69 +59,378 @@ def short_stack_name(name):
     return name.split("/")[1]
 
 
-def get_pending_resources(stack):
-    pending_resources = []
-    for sub in stack.resource_summaries.all():
-        if (
-            "IN_PROGRESS" not in sub.resource_status
-            and "FAILED" not in sub.resource_status
-        ) or "COMPLETE" in sub.resource_status:
+PendingResource = collections.namedtuple(
+    "PendingResource",
+    (
+        "stack_id",
+        "short_stack_name",
+        "logical_resource_id",
+        "physical_resource_id",
+        "resource_type",
+        "resource_status",
+        "resource_status_reason",
+        "last_updated_timestamp",
+        # How long the resource has been changing for, how long changes to it usually take and how long until it
+        # should be done. Empty if there are no past changes to compare with.
+        "elapsed",
+        "expected",
+        "eta",
+    ),
+)
+
+
+def is_pending(status):
+    return ("IN_PROGRESS" in status or "FAILED" in status) and "COMPLETE" not in status
+
+
+def list_pending_resources_requests(stack_id):
+    """Return the resources in a single stack which aren't complete."""
+    resources = yield from cloudformation.list_stack_resources_requests(stack_id)
+    return [
+        PendingResource(
+            stack_id,
+            short_stack_name(stack_id),
+            resource.logical_resource_id,
+            resource.physical_resource_id,
+            resource.resource_type,
+            resource.resource_status,
+            resource.resource_status_reason,
+            resource.last_updated_timestamp,
+            "",
+            "",
+            "",
+        )
+        for resource in resources
+        if is_pending(resource.resource_status)
+    ]
+
+
+def pending_nested_stacks(stack_id, pending_resources):
+    return [
+        r.physical_resource_id
+        for r in pending_resources
+        if r.resource_type == STACK_TYPE and r.physical_resource_id
+    ]
+
+
+# The kinds of item in a traversal of the pending stacks: listing a stack's resources or reading its operation's events.
+RESOURCES = "resources"
+EVENTS = "events"
+
+
+def pending_stack_requests(item):
+    """Return a stack's pending resources or the events of its operation, for a (stack_id, kind) item."""
+    stack_id, kind = item
+    if kind == EVENTS:
+        return (yield from cloudformation.operation_events_requests(stack_id))
+    return (yield from list_pending_resources_requests(stack_id))
+
+
+def pending_stack_items(item, result, with_events=False):
+    """Return the items to traverse after item: its pending nested stacks and then, if with_events, its events.
+
+    The events are their own items so that reading them never holds back the stack's rows or its nested stacks.
+    """
+    stack_id, kind = item
+    if kind == EVENTS:
+        return []
+    items = [
+        (nested_id, RESOURCES) for nested_id in pending_nested_stacks(stack_id, result)
+    ]
+    if with_events and result:
+        items.append((stack_id, EVENTS))
+    return items
+
+
+def learn_operation(model, events, now):
+    """Learn from the finished changes in a stack's operation events.
+
+    Returns when each change which is still in progress started, by logical resource ID.
+    """
+    spans = cloudformation.resource_spans(events, now)
+    model.learn(spans, now)
+    return {
+        span.logical_resource_id: span.start
+        for span in spans
+        if span.resource_status.endswith("IN_PROGRESS")
+    }
+
+
+def estimate_columns(elapsed, estimate):
+    """Return the expected and ETA columns for a change which has been going for elapsed."""
+    if estimate is None:
+        return "", ""
+    expected = durations.format_duration(estimate.p50)
+    if estimate.p95 > estimate.p50:
+        expected = "%s-%s" % (expected, durations.format_duration(estimate.p95))
+    if elapsed < estimate.p50:
+        return expected, "~%s" % (durations.format_duration(estimate.p50 - elapsed),)
+    if elapsed < estimate.p95:
+        return expected, "<%s" % (durations.format_duration(estimate.p95 - elapsed),)
+    return expected, SLOW
+
+
+def timed(resource, started, model, now):
+    """Fill in a pending resource's timing columns.
+
+    The change started at its first event in started, or if its events haven't been read, at the resource's last
+    update, which only misses any earlier *_IN_PROGRESS events of the same change.
+    """
+    start = started.get(resource.logical_resource_id)
+    if start is None:
+        if not resource.resource_status.endswith("IN_PROGRESS"):
+            return resource
+        start = resource.last_updated_timestamp
+    if start is None:
+        return resource
+    elapsed = now - start
+    expected, eta = estimate_columns(
+        elapsed,
+        model.estimate(
+            resource.resource_status,
+            resource.resource_type,
+            resource.logical_resource_id,
+        ),
+    )
+    return resource._replace(
+        elapsed=durations.format_duration(elapsed), expected=expected, eta=eta
+    )
+
+
+def iter_pending_resources(engine, stack_name_or_id, model=None):
+    """Yield the resources which aren't complete in a stack and every pending stack nested in it, a stack at a time.
+
+    Each pending nested stack is listed as soon as its parent has been, concurrently with every other stack, and its
+    resources are yielded as soon as they are listed. A stack's resources always come after its parent's. With a
+    durations.DurationModel the pending resources are timed from their last update, and the events of each stack's
+    operation are read after it has been listed to learn from its finished changes.
+    """
+    for (stack_id, kind), result in engine.traverse(
+        pending_stack_requests,
+        [(stack_name_or_id, RESOURCES)],
+        lambda item, result: pending_stack_items(item, result, model is not None),
+    ):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if kind == EVENTS:
+            learn_operation(model, result, now)
             continue
-        sub.short_stack_name = short_stack_name(sub.stack_name)
-        pending_resources.append(sub)
-        if sub.resource_type == STACK_TYPE:
-            pending_resources.extend(
-                get_pending_resources(get_stack(sub.physical_resource_id))
+        if model is not None:
+            result = [timed(resource, {}, model, now) for resource in result]
+        yield result
+
+
+class PendingTree(object):
+    """The pending resources of a stack and the pending stacks nested in it, kept up to date from their events.
+
+    Each refresh reads the newest page of events of each pending stack and only lists the resources of the stacks
+    which have new events again, along with any stacks newly nested in them. Stacks which are no longer pending are
+    dropped with everything nested in them. With a durations.DurationModel the events of each stack's operation are
+    kept to time its pending resources, and its changes are learned as they finish.
+    """
+
+    def __init__(self, engine, root, model=None):
+        self.engine = engine
+        self.root = root
+        self.model = model
+        self.resources = {}
+        self.cursors = {}
+        self.events = {}
+        self.started = {}
+
+    def load(self, stack_ids):
+        """List the stacks and every pending stack nested in them and start following their events."""
+        loaded = []
+        for (stack_id, kind), result in self.engine.traverse(
+            pending_stack_requests,
+            [(stack_id, RESOURCES) for stack_id in stack_ids],
+            lambda item, result: pending_stack_items(
+                item, result, self.model is not None
+            ),
+        ):
+            if kind == EVENTS:
+                self.events[stack_id] = result
+            else:
+                self.resources[stack_id] = result
+                self.events.setdefault(stack_id, [])
+                loaded.append(stack_id)
+        unread = []
+        for stack_id in loaded:
+            cursor = self.cursors[stack_id] = cloudformation.StackCursor(stack_id)
+            if self.events[stack_id]:
+                cursor.last_event_id = self.events[stack_id][-1].id
+            else:
+                unread.append(stack_id)
+        # The first poll only finds where the events are up to.
+        self.engine.map(lambda stack_id: self.cursors[stack_id].poll_requests(), unread)
+        self._learn(loaded)
+
+    def _learn(self, stack_ids):
+        if self.model is None:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for stack_id in stack_ids:
+            self.started[stack_id] = learn_operation(
+                self.model, self.events[stack_id], now
             )
-    return pending_resources
+
+    def _add_events(self, stack_id, new_events):
+        """Add a stack's new events to those of its operation, starting over if a new operation has started."""
+        events = self.events.get(stack_id, []) + new_events
+        for i in range(len(events) - 1, -1, -1):
+            event = events[i]
+            if (
+                cloudformation.is_own_event(event)
+                and event.resource_status in cloudformation.OPERATION_START_STATUSES
+            ):
+                events = events[i:]
+                break
+        self.events[stack_id] = events
+
+    def refresh(self):
+        """Bring the tree up to date. Returns the number of stacks which were listed again."""
+        stack_ids = list(self.cursors)
+        changed = []
+        for stack_id, events in zip(
+            stack_ids,
+            self.engine.map(
+                lambda stack_id: self.cursors[stack_id].poll_requests(), stack_ids
+            ),
+        ):
+            if events:
+                changed.append(stack_id)
+                if self.model is not None:
+                    self._add_events(stack_id, events)
+        nested = []
+        for stack_id, pending_resources in zip(
+            changed, self.engine.map(list_pending_resources_requests, changed)
+        ):
+            self.resources[stack_id] = pending_resources
+            nested.extend(
+                nested_id
+                for nested_id in pending_nested_stacks(stack_id, pending_resources)
+                if nested_id not in self.resources
+            )
+        self._learn(changed)
+        reachable = set(self.stack_ids())
+        for stack_id in list(self.resources):
+            if stack_id not in reachable:
+                del self.resources[stack_id]
+                del self.cursors[stack_id]
+                self.events.pop(stack_id, None)
+                self.started.pop(stack_id, None)
+        if nested:
+            self.load(nested)
+        return len(changed)
+
+    def stack_ids(self):
+        """Return the ids of the stacks which are still pending, parents first."""
+        stack_ids = [self.root]
+        for stack_id in stack_ids:
+            stack_ids.extend(
+                nested_id
+                for nested_id in pending_nested_stacks(
+                    stack_id, self.resources.get(stack_id, [])
+                )
+                if nested_id in self.resources
+            )
+        return stack_ids
+
+    def rows(self, stack_id=None, now=None):
+        """Return the pending resources in tree order, with each pending nested stack's resources right after it."""
+        stack_id = stack_id or self.root
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        rows = []
+        for resource in self.resources.get(stack_id, []):
+            if self.model is not None:
+                resource = timed(
+                    resource, self.started.get(stack_id, {}), self.model, now
+                )
+            rows.append(resource)
+            if resource.resource_type == STACK_TYPE and resource.physical_resource_id:
+                rows.extend(self.rows(resource.physical_resource_id, now))
+        return rows
+
+
+def watch(engine, stack_name_or_id, table, interval, model=None):
+    tree = PendingTree(engine, stack_name_or_id, model)
+    tree.load([stack_name_or_id])
+    live = tables.LiveTable(table)
+    listed = len(tree.resources)
+    while True:
+        try:
+            if model is not None:
+                model.save(datetime.datetime.now(datetime.timezone.utc))
+            rows = tree.rows()
+            live.update(
+                rows,
+                "%s: %d pending resources in %d stacks, listed %d stacks"
+                % (
+                    datetime.datetime.now().strftime("%H:%M:%S"),
+                    len(rows),
+                    len(tree.resources),
+                    listed,
+                ),
+            )
+            time.sleep(interval)
+            listed = tree.refresh()
+        except Exception:
+            traceback.print_exc()
+            live.forget()
 
 
 def main():
     args = docopt.docopt(__doc__)
-    if args["--profile"]:
-        boto3.setup_default_session(profile_name=args["--profile"])
 
     max_column_length = args["--max-column-length"]
     if max_column_length is None:
         max_column_length = 200
 
-    columns = collections.OrderedDict(
-        [
-            ("short_stack_name", Column(0, max_column_length)),
-            ("logical_resource_id", Column(0, max_column_length)),
-            # ('stack_id', Column(0, max_column_length)),
-            ("resource_type", Column(0, max_column_length)),
-            ("resource_status", Column(0, max_column_length)),
-            ("resource_status_reason", Column(0, max_column_length)),
-        ]
-    )
-    headers = collections.namedtuple("Headers", columns.keys())(
-        *[
-            colorama.Style.BRIGHT + t + colorama.Style.RESET_ALL
-            for t in [
-                "Stack Name",
-                "Logical Resource ID",
-                # 'Stack ID',
-                "Resource Type",
-                "Status",
-                "Reason",
-            ]
-        ]
-    )
-    update_columns(columns, [headers])
-
-    print("Getting stack...")
-    main_stack = get_stack(args["<stack>"])
-
-    pending_resources = get_pending_resources(main_stack)
-    if not pending_resources:
-        print("None")
-        sys.exit(0)
-
-    update_columns(columns, pending_resources)
+    model = None
+    if not args["--no-durations"]:
+        model = durations.DurationModel(args["--durations-file"])
+
+    columns = [
+        ("short_stack_name", "Stack Name"),
+        ("logical_resource_id", "Logical Resource ID"),
+        # ("stack_id", "Stack ID"),
+        ("resource_type", "Resource Type"),
+        ("resource_status", "Status"),
+    ]
+    if model is not None:
+        columns.extend(
+            [("elapsed", "Elapsed"), ("expected", "p50-p95"), ("eta", "ETA")]
+        )
+    columns.append(("resource_status_reason", "Reason"))
+    table = tables.Table(columns, int(max_column_length))
 
-    output_events(columns, [headers])
-    output_events(columns, pending_resources)
+    metrics.setup(args["--prometheus-file"])
+    engine = clients.get_engine("cloudformation", args["--asyncio"], args["--profile"])
+    try:
+        # ListStackResources takes the stack's name as well as its id, so there's no need to describe it first.
+        if args["--watch"]:
+            watch(engine, args["<stack>"], table, float(args["--interval"]), model)
+        else:
+            found = False
+            for pending_resources in iter_pending_resources(
+                engine, args["<stack>"], model
+            ):
+                if pending_resources:
+                    found = True
+                    table.widen(pending_resources)
+                    table.write(pending_resources)
+            if not found:
+                print("None")
+    finally:
+        engine.close()
+        if model is not None:
+            model.save(datetime.datetime.now(datetime.timezone.utc))
+        if args["--stats"]:
+            print(
+                "stats: %s %s"
+                % (engine.controller.format_stats(), table.format_stats()),
+                file=sys.stderr,
+            )
+            metrics.print_stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,273 @@
+"""Right-aligned, colorized table output for stack events and resources.
+
+Column widths only ever grow. The layout is recompiled when a width changes rather than for every row, and headers
+are only written again when the widths change or after HEADER_EVERY rows, so a long follow doesn't repeat them every
+poll. LiveTable keeps a table on a terminal for watch modes, rewriting only the lines which change, with every line
+clipped to the terminal's width and the rows cut short to fit its height.
+"""
+import math
+import re
+import shutil
+import sys
+import time
+
+import colorama
+
+
+ELLIPSIS = u"\u2026"
+
+HEADER_EVERY = 50
+
+STATUS_COLUMN = "resource_status"
+
+
+def status_color(status):
+    status = status.upper()
+    if "FAIL" in status:
+        return colorama.Fore.RED
+    elif "ROLLBACK" in status:
+        return colorama.Fore.YELLOW
+    elif "IN_PROGRESS" in status:
+        return colorama.Fore.BLUE
+    elif status == "DELETE_COMPLETE":
+        return colorama.Fore.LIGHTBLACK_EX
+    elif "COMPLETE" in status:
+        return colorama.Fore.GREEN
+    return colorama.Fore.WHITE
+
+
+def truncate(text, max_length):
+    if len(text) <= max_length:
+        return text
+    half_length = (max_length - 1) / 2.0
+    return "%s%s%s" % (
+        text[: int(math.floor(half_length))],
+        ELLIPSIS,
+        text[-int(math.ceil(half_length)) :],
+    )
+
+
+class Column(object):
+    def __init__(self, name, title, max_length, left_aligned=False):
+        self.name = name
+        self.title = title
+        self.max_length = max_length
+        self.left_aligned = left_aligned
+        self.width = min(len(title), max_length)
+
+    def header(self):
+        title = truncate(self.title, self.width)
+        padding = " " * (self.width - len(title))
+        title = "%s%s%s" % (colorama.Style.BRIGHT, title, colorama.Style.RESET_ALL)
+        return title + padding if self.left_aligned else padding + title
+
+
+class Table(object):
+    """Writes rows (objects with an attribute per column) as a table.
+
+    columns is a list of (attribute, title) pairs. Columns are right-aligned except for those named in left_aligned.
+    Each batch of rows passed to write is written with one call to the output's write.
+    """
+
+    def __init__(
+        self, columns, max_length, out=None, header_every=HEADER_EVERY, left_aligned=(),
+    ):
+        self.columns = [
+            Column(name, title, max_length, name in left_aligned)
+            for name, title in columns
+        ]
+        self.out = out or sys.stdout
+        self.header_every = header_every
+        self.rows_since_header = None
+        self.rows_written = 0
+        self.write_time = 0.0
+        self._status_cache = {}
+        self._compile()
+
+    def _compile(self):
+        self._widths = [column.width for column in self.columns]
+        self._names = [column.name for column in self.columns]
+        self._status_index = (
+            self._names.index(STATUS_COLUMN) if STATUS_COLUMN in self._names else None
+        )
+        self._format = (
+            "  ".join(
+                "%-*s" if column.left_aligned else "%*s" for column in self.columns
+            )
+            + "\n"
+        )
+        self._header = "%s\n" % ("  ".join(column.header() for column in self.columns),)
+
+    def widen(self, rows):
+        """Grow the columns to fit rows. Returns True if any column changed width."""
+        changed = False
+        for i, name in enumerate(self._names):
+            column = self.columns[i]
+            if column.width >= column.max_length:
+                continue
+            width = max(len(str(getattr(row, name))) for row in rows) if rows else 0
+            width = min(width, column.max_length)
+            if width > column.width:
+                column.width = width
+                changed = True
+        if changed:
+            self._compile()
+            # New widths make the last header misleading.
+            self.rows_since_header = None
+        return changed
+
+    def colorize(self, status, width):
+        key = (status, width)
+        cell = self._status_cache.get(key)
+        if cell is None:
+            text = truncate(status, width)
+            cell = "%s%s%s%s" % (
+                " " * (width - len(text)),
+                status_color(status),
+                text,
+                colorama.Style.RESET_ALL,
+            )
+            self._status_cache[key] = cell
+        return cell
+
+    def format_row(self, row):
+        values = []
+        for i, name in enumerate(self._names):
+            width = self._widths[i]
+            if i == self._status_index:
+                # Color codes take up no space on screen so the cell is padded before they are added.
+                values.append(0)
+                values.append(self.colorize(getattr(row, name), width))
+            else:
+                values.append(width)
+                values.append(truncate(str(getattr(row, name)), width))
+        return self._format % tuple(values)
+
+    def write(self, rows, headers=None):
+        """Write rows, preceded by the headers if they are due. headers=True or False forces them on or off."""
+        start = time.time()
+        if headers is None:
+            headers = (
+                self.rows_since_header is None
+                or self.rows_since_header >= self.header_every
+            )
+        lines = []
+        if headers:
+            lines.append(self._header)
+            self.rows_since_header = 0
+        for row in rows:
+            lines.append(self.format_row(row))
+        self.rows_since_header = (self.rows_since_header or 0) + len(rows)
+        self.out.write("".join(lines))
+        self.out.flush()
+        self.rows_written += len(rows)
+        self.write_time += time.time() - start
+
+    def format_stats(self):
+        return "rows_written=%d render_time=%.3fs" % (
+            self.rows_written,
+            self.write_time,
+        )
+
+
+CLEAR_LINE = "\x1b[2K"
+CLEAR_TO_END = "\x1b[J"
+
+ANSI_ESCAPE = re.compile(r"(\x1b\[[0-9;]*[A-Za-z])")
+
+
+def clip(line, width):
+    """Cut a line, which may hold color codes and end with a newline, to width characters on screen."""
+    # Color codes only ever make a line longer than it shows, so most lines don't need to be looked at.
+    if len(line) <= width + 1:
+        return line
+    text = line.rstrip("\n")
+    if len(ANSI_ESCAPE.sub("", text)) <= width:
+        return line
+    parts = []
+    room = width - 1
+    for i, part in enumerate(ANSI_ESCAPE.split(text)):
+        # Color codes after the cut are kept so that colors are still reset.
+        if i % 2 == 0:
+            part = part[: max(room, 0)]
+            room -= len(part)
+        parts.append(part)
+    return "%s%s%s%s" % (
+        "".join(parts),
+        ELLIPSIS,
+        colorama.Style.RESET_ALL,
+        line[len(text) :],
+    )
+
+
+def move_cursor(lines):
+    """Return the escape code to move the cursor down lines lines, or up if lines is negative."""
+    if lines < 0:
+        return colorama.Cursor.UP(-lines)
+    elif lines > 0:
+        return colorama.Cursor.DOWN(lines)
+    return ""
+
+
+class LiveTable(object):
+    """Keeps a table on a terminal and redraws only the lines which change.
+
+    Lines are found by moving the cursor up from the end of the table, so nothing else may be written while it is
+    shown (call forget after anything else is). Lines are clipped to the terminal's width so that they never wrap, and
+    rows which don't fit in its height are left out and counted on a line of their own. footer is an extra line, such
+    as a status line, shown under the rows.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.lines = []
+
+    def forget(self):
+        """Start drawing the table afresh under whatever is on the terminal."""
+        self.lines = []
+
+    def update(self, rows, footer=None):
+        """Show rows, rewriting only the lines which differ from what is shown. Returns how many were rewritten."""
+        start = time.time()
+        self.table.widen(rows)
+        size = shutil.get_terminal_size()
+        # The cursor waits on the line under the table, and the header and footer need a line each.
+        room = max(1, size.lines - 2 - (footer is not None))
+        if len(rows) > room:
+            hidden = len(rows) - room + 1
+            rows = rows[: room - 1]
+        else:
+            hidden = 0
+        lines = [self.table._header] + [self.table.format_row(row) for row in rows]
+        if hidden:
+            lines.append("%s more rows not shown\n" % (hidden,))
+        if footer is not None:
+            lines.append("%s\n" % (footer,))
+        # Writing in the last column can wrap the line on some terminals, so it is left empty.
+        lines = [clip(line, size.columns - 1) for line in lines]
+        old = self.lines
+        out = []
+        if len(lines) == len(old):
+            changed = [i for i, line in enumerate(lines) if line != old[i]]
+            position = len(old)
+            for i in changed:
+                out.append(move_cursor(i - position))
+                out.append("\r" + CLEAR_LINE + lines[i])
+                position = i + 1
+            if changed:
+                out.append(move_cursor(len(old) - position))
+        else:
+            first = 0
+            while first < min(len(lines), len(old)) and lines[first] == old[first]:
+                first += 1
+            changed = range(first, len(lines))
+            out.append(move_cursor(first - len(old)))
+            out.append("\r" + CLEAR_TO_END)
+            out.extend(lines[first:])
+        self.lines = lines
+        if out:
+            self.table.out.write("".join(out))
+            self.table.out.flush()
+        self.table.rows_written += len(changed)
+        self.table.write_time += time.time() - start
+        return len(changed)
@@ -1,128 +1,1302 @@
 #!/usr/bin/env python
 """Usage:
-    tail_cloudwatch_logs.py [--follow] [--profile=<profile>] [--number=<n>] <log_group>
+    tail_cloudwatch_logs.py [options] <log_group>...
+    tail_cloudwatch_logs.py [options] --prefix=<prefix>
+    tail_cloudwatch_logs.py export --start=<t> [options] <log_group>...
+    tail_cloudwatch_logs.py export --start=<t> [options] --prefix=<prefix>
+    tail_cloudwatch_logs.py query --start=<t> (--query=<q>)... [options] (<log_group>... | --prefix=<prefix>)
 
 Options:
     -f --follow                    Follow the log events and output new ones as they are received.
     -p <p> --profile=<profile>     The aws profile to use.
     -n <n> --number=<n>            The number of lines to display. [default: 10]
-    <log_group>                    The log group to get log events for.
+    -e <e> --engine=<engine>       How to read events. "filter" uses FilterLogEvents so CloudWatch Logs interleaves
+                                   events from every stream in the group server-side. "streams" polls the most
+                                   recently active streams one at a time. Only the filter engine uses the local
+                                   event cache. [default: filter]
+    --min-interval=<s>             The shortest time to wait between polls while events are arriving. [default: 0.5]
+    --max-interval=<s>             The longest time to wait between polls when the log groups are idle or the API is
+                                   throttling us. [default: 30]
+    --asyncio                      Poll with aiobotocore on an asyncio event loop instead of with eventlet.
+    --stats                        Print polling statistics, including the current poll interval, the API
+                                   concurrency and the calls, retries, throttles, bytes and latency of each API
+                                   operation, to stderr every minute and on exit.
+    --prometheus-file=<path>       Keep the API metrics in this file in the Prometheus text format, e.g. for
+                                   node_exporter's textfile collector.
+    --stream-ttl=<s>               With the streams engine, stop polling streams which have had no events for this
+                                   many seconds. [default: 1800]
+    --max-streams=<n>              With the streams engine, the most streams to poll at once. Only the most recently
+                                   active streams are polled. [default: 50]
+    --filter-pattern=<p>           A CloudWatch Logs filter pattern applied server-side, so only matching events are
+                                   transferred. Needs the filter engine and turns off the local event cache.
+    --match=<regex>                Only show events whose message matches this regular expression.
+    --fields=<fields>              Only show these comma-separated fields of each message. Fields are taken from the
+                                   named groups of --match if it has them, otherwise from the JSON object in the
+                                   message. Nested JSON fields are separated by dots, e.g. error.type.
+    -s <t> --since=<t>             Show every event since this time instead of the last n. Either a relative time
+                                   such as 90s, 30m, 2h, 1d or 1w, an ISO 8601 date/time or epoch milliseconds.
+    --offline                      Only read events from the local cache, without making any API calls.
+    --no-cache                     Don't read or store events in the local cache.
+    --cache-dir=<dir>              Where the local event cache is kept. Defaults to ~/.cache/aws_utilities/logs.
+    --cache-size=<mb>              The most disk space the local event cache may use. [default: 512]
+    --start=<t>                    Export or query events from this time. Takes the same formats as --since.
+    --end=<t>                      Export or query events up to this time. Defaults to now.
+    --output-dir=<dir>             Write exported events to a gzipped JSON lines file per log group in this directory
+                                   instead of printing them.
+    --slices=<n>                   Split the export into this many time slices to start with. Slices with a lot of
+                                   events are split further as they are read. [default: 8]
+    --concurrency=<n>              The most export calls to make at once, up to 64, or 2048 with --asyncio.
+                                   [default: 8]
+    -q <q> --query=<q>             A CloudWatch Logs Insights query to run over the log groups. Can be given more than
+                                   once to run several queries at the same time. Rows are printed as they arrive
+                                   unless the query aggregates, in which case they are printed when it finishes.
+    --prefix=<prefix>              Get log events for every log group whose name starts with this prefix.
+    <log_group>                    The log groups to get log events for.
 """
+import collections
 import datetime
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import re
 import sys
 import time
 import traceback
 
-import eventlet
+if __name__ == "__main__":
+    # Running the script directly rather than through its console script, so patch before botocore is imported.
+    from aws_utilities import entry_points
 
-eventlet.monkey_patch()
+    entry_points.setup()
 
 import botocore.exceptions
-import boto3
 import docopt
 import eventlet
-import eventlet.greenpool
+import eventlet.patcher
 
+from aws_utilities import clients
+from aws_utilities import concurrency
+from aws_utilities import log_cache
+from aws_utilities import metrics
 
-def main():
-    args = docopt.docopt(__doc__)
-    if args["--profile"]:
-        boto3.setup_default_session(profile_name=args["--profile"])
-    num = int(args["--number"])
-    log_group = args["<log_group>"]
-
-    cwl = boto3.client("logs")
-
-    def get_log_streams(log_group):
-        log_streams = [
-            ls["logStreamName"]
-            for ls in cwl.describe_log_streams(
-                logGroupName=log_group,
-                orderBy="LastEventTime",
-                descending=True,
-                limit=10,
-            )["logStreams"]
-        ]
-        return log_streams
 
-    log_streams = set(get_log_streams(log_group))
+ENGINES = ("filter", "streams")
 
-    def get_stream_events(log_group, log_stream, num, start_time):
-        try:
-            events = []
-            for event in cwl.get_log_events(
-                logGroupName=log_group,
-                logStreamName=log_stream,
-                limit=num,
-                startTime=start_time,
-            )["events"]:
-                event["log_group"] = log_group
-                event["log_stream"] = log_stream
+# The size of the first window searched backwards from now when looking for the last n events. Each following window
+# is WINDOW_GROWTH times larger so that sparse log groups only take a handful of calls to reach their oldest events.
+INITIAL_WINDOW_MS = 60 * 1000
+WINDOW_GROWTH = 4
+
+# The number of recently output event ids remembered for de-duplication while following.
+DEDUPE_SIZE = 20000
+
+# Events can be ingested a little after events with newer timestamps from other streams, so each read while following
+# looks this far back behind the newest timestamp already read. The events it reads again are dropped as duplicates,
+# which needs the events in this window to fit in DEDUPE_SIZE.
+LOOKBACK_MS = 10 * 1000
+
+# How quickly the poll interval shrinks while events arrive and grows while idle. Throttling grows it twice as fast.
+BACKOFF = 2.0
+# Log streams are listed far less often than events are polled as DescribeLogStreams has a low rate limit.
+MIN_STREAM_REFRESH_INTERVAL = 5
+# lastEventTimestamp is only eventually consistent, so each stream refresh looks this far behind the newest
+# timestamp seen by the previous refresh.
+REFRESH_OVERLAP_MS = 5 * 60 * 1000
+STATS_INTERVAL = 60
+
+# The most log groups a single Logs Insights query can search. Queries over more log groups are run in batches.
+QUERY_LOG_GROUPS = 50
+QUERY_MIN_INTERVAL = 0.5
+QUERY_MAX_INTERVAL = 5
+QUERY_DONE_STATUSES = ("Complete", "Failed", "Cancelled", "Timeout", "Unknown")
+
+# Export slices, and the time ranges searched for the last events of a log group, with more than a page of events are
+# split into this many parts, unless they are already shorter than MIN_SLICE_MS.
+SLICE_SPLIT = 4
+MIN_SLICE_MS = 1000
+
+
+class AdaptiveInterval(object):
+    """Decides how long to wait before the next poll.
+
+    The interval halves (down to floor) after each poll which returned events and doubles (up to ceiling) after each
+    idle poll, so busy log groups are read with low latency while quiet ones cost almost nothing.
+    """
+
+    def __init__(self, floor, ceiling, backoff=BACKOFF):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.backoff = backoff
+        self.current = floor
+        self.polls = 0
+        self.events = 0
+        self.throttles = 0
+        self._throttled = False
+
+    def throttled(self):
+        self.throttles += 1
+        self._throttled = True
+
+    def update(self, num_events):
+        self.polls += 1
+        self.events += num_events
+        if self._throttled:
+            self.current *= self.backoff ** 2
+        elif num_events:
+            self.current /= self.backoff
+        else:
+            self.current *= self.backoff
+        self.current = min(self.ceiling, max(self.floor, self.current))
+        self._throttled = False
+
+    def sleep(self):
+        time.sleep(self.current)
+
+    def format_stats(self):
+        return "polls=%d events=%d throttles=%d interval=%.2fs" % (
+            self.polls,
+            self.events,
+            self.throttles,
+            self.current,
+        )
+
+
+class EventIdCache(object):
+    """A fixed-size set of recently seen event ids which forgets the least recently seen id when full."""
+
+    def __init__(self, max_size=DEDUPE_SIZE):
+        self.max_size = max_size
+        self._ids = collections.OrderedDict()
+
+    def __contains__(self, event_id):
+        return event_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, event_id):
+        """Remember event_id, returning False if it had already been seen."""
+        if event_id in self._ids:
+            self._ids.move_to_end(event_id)
+            return False
+        self._ids[event_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+
+def event_id(event):
+    # GetLogEvents doesn't return event ids so we build one from what uniquely identifies the event in its stream.
+    # Messages can be up to 256KB, so the id holds a digest of the message rather than the message itself.
+    if "eventId" in event:
+        return event["eventId"]
+    return (
+        event["log_group"],
+        event["log_stream"],
+        event["timestamp"],
+        event.get("ingestionTime"),
+        hashlib.blake2b(event["message"].encode(), digest_size=16).digest(),
+    )
+
+
+class StreamCursor(object):
+    """Tracks how far into a single log stream we have read.
+
+    The first read returns the last `num` events in the stream, or the events since start_time if one is given. Every
+    read after that continues from the stream's nextForwardToken so only events we haven't seen are fetched.
+    """
+
+    def __init__(self, log_group, log_stream, start_time=None):
+        self.log_group = log_group
+        self.log_stream = log_stream
+        self.start_time = start_time
+        self.next_token = None
+        self.last_event_id = None
+        self.last_timestamp = start_time or 0
+
+    def read_requests(self, num):
+        kwargs = {"logGroupName": self.log_group, "logStreamName": self.log_stream}
+        if self.next_token is not None:
+            kwargs.update(nextToken=self.next_token, startFromHead=True)
+        elif self.start_time is not None:
+            kwargs.update(startTime=self.start_time, startFromHead=True)
+        else:
+            kwargs.update(limit=num, startFromHead=False)
+        events = []
+        while True:
+            response = yield "get_log_events", kwargs
+            for event in response["events"]:
+                event["log_group"] = self.log_group
+                event["log_stream"] = self.log_stream
                 events.append(event)
-            return events
-        except botocore.exceptions.ClientError:
+            next_token = response["nextForwardToken"]
+            # The same token coming back means we're at the end of the stream. The first read of the last `num`
+            # events is a single page.
+            done = next_token == kwargs.get("nextToken") or "limit" in kwargs
+            self.next_token = next_token
+            if done:
+                break
+            kwargs = {
+                "logGroupName": self.log_group,
+                "logStreamName": self.log_stream,
+                "nextToken": next_token,
+                "startFromHead": True,
+            }
+        if events:
+            self.last_event_id = event_id(events[-1])
+            self.last_timestamp = max(self.last_timestamp, events[-1]["timestamp"])
+        return events
+
+
+class StreamManager(object):
+    """Keeps the set of log streams being polled bounded.
+
+    Streams are listed most recently active first and listing stops as soon as it reaches streams which were already
+    known to the previous refresh, so a refresh costs one page on all but the busiest log groups no matter how many
+    streams they have. Streams which have been idle for longer than ttl_ms are retired and only the max_streams most
+    recently active are polled.
+    """
+
+    def __init__(self, log_groups, ttl_ms, max_streams, start_time=None):
+        self.log_groups = log_groups
+        self.start_time = start_time
+        self.ttl_ms = ttl_ms
+        self.max_streams = max_streams
+        self.cursors = {}
+        self.last_event_timestamps = {}
+        self.retired = 0
+        self._high_water = {}
+        self._refreshed_at = None
+
+    def __len__(self):
+        return len(self.cursors)
+
+    def values(self):
+        return list(self.cursors.values())
+
+    def list_active_streams_requests(self, log_group, now):
+        """Return (log_stream, lastEventTimestamp) for the streams with events since the last refresh."""
+        # The first refresh ignores the ttl so that the last events of a quiet log group can still be shown.
+        cutoff = 0 if self._refreshed_at is None else now - self.ttl_ms
+        if log_group in self._high_water:
+            cutoff = max(cutoff, self._high_water[log_group] - REFRESH_OVERLAP_MS)
+        kwargs = {
+            "logGroupName": log_group,
+            "orderBy": "LastEventTime",
+            "descending": True,
+        }
+        found = []
+        while True:
+            response = yield "describe_log_streams", kwargs
+            for ls in response["logStreams"]:
+                timestamp = ls.get("lastEventTimestamp", ls["creationTime"])
+                if timestamp < cutoff or len(found) >= self.max_streams:
+                    return found
+                found.append((ls["logStreamName"], timestamp))
+                self._high_water[log_group] = max(
+                    self._high_water.get(log_group, 0), timestamp
+                )
+            if "nextToken" not in response:
+                return found
+            kwargs["nextToken"] = response["nextToken"]
+
+    def refresh(self, api):
+        """List recently active streams in every log group at once, retiring idle ones. Returns the number added."""
+        now = now_ms()
+        # Streams which show up after the first refresh only need the events written since the previous one.
+        start_time = (
+            self.start_time
+            if self._refreshed_at is None
+            else self._refreshed_at - REFRESH_OVERLAP_MS
+        )
+        added = 0
+        listed = api.map(
+            lambda log_group: self.list_active_streams_requests(log_group, now),
+            self.log_groups,
+        )
+        for log_group, active_streams in zip(self.log_groups, listed):
+            for log_stream, timestamp in active_streams:
+                key = (log_group, log_stream)
+                self.last_event_timestamps[key] = max(
+                    self.last_event_timestamps.get(key, 0), timestamp
+                )
+                if key not in self.cursors:
+                    added += 1
+                    self.cursors[key] = StreamCursor(
+                        log_group, log_stream, start_time=start_time
+                    )
+        if self._refreshed_at is not None:
+            self.retire(now)
+        self._refreshed_at = now
+        return added
+
+    def last_active(self, key):
+        return max(
+            self.last_event_timestamps.get(key, 0), self.cursors[key].last_timestamp
+        )
+
+    def retire(self, now):
+        active = sorted(self.cursors, key=self.last_active, reverse=True)
+        for i, key in enumerate(active):
+            if i >= self.max_streams or self.last_active(key) < now - self.ttl_ms:
+                del self.cursors[key]
+                self.last_event_timestamps.pop(key, None)
+                self.retired += 1
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+RELATIVE_TIME_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+    "w": 7 * 24 * 60 * 60,
+}
+
+
+def parse_time(value):
+    """Parse a relative time (such as 30m), an ISO 8601 date/time or epoch milliseconds into epoch milliseconds."""
+    match = re.match(r"^(\d+)([smhdw])$", value)
+    if match:
+        return (
+            now_ms() - int(match.group(1)) * RELATIVE_TIME_UNITS[match.group(2)] * 1000
+        )
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        raise ValueError("Unable to parse time %r" % (value,))
+
+
+def log_groups_requests(prefix):
+    """Return the names of the log groups whose names start with prefix."""
+    kwargs = {"logGroupNamePrefix": prefix}
+    log_groups = []
+    while True:
+        response = yield "describe_log_groups", kwargs
+        log_groups.extend(group["logGroupName"] for group in response["logGroups"])
+        if "nextToken" not in response:
+            return log_groups
+        kwargs["nextToken"] = response["nextToken"]
+
+
+def log_group_creation_time_requests(log_group):
+    response = yield "describe_log_groups", {"logGroupNamePrefix": log_group}
+    for group in response["logGroups"]:
+        if group["logGroupName"] == log_group:
+            return group["creationTime"]
+    return 0
+
+
+def filter_events_page_requests(
+    log_group, start_time, end_time=None, filter_pattern=None, next_token=None
+):
+    """Read a page of FilterLogEvents. Returns the events and the token for the next page, or None at the end."""
+    kwargs = {"logGroupName": log_group, "startTime": start_time, "interleaved": True}
+    if end_time is not None:
+        kwargs["endTime"] = end_time
+    if filter_pattern:
+        kwargs["filterPattern"] = filter_pattern
+    if next_token:
+        kwargs["nextToken"] = next_token
+    response = yield "filter_log_events", kwargs
+    for event in response["events"]:
+        event["log_group"] = log_group
+        event["log_stream"] = event["logStreamName"]
+    token = response.get("nextToken")
+    return response["events"], (None if token == next_token else token)
+
+
+def filter_range_requests(
+    log_group, start_time, end_time=None, filter_pattern=None, keep=None
+):
+    """Return the events in all streams of a log group between start_time and end_time (both inclusive).
+
+    CloudWatch Logs does the interleaving across streams, so the number of calls depends on the number of events
+    rather than the number of streams. If keep is given only the last keep events are returned.
+    """
+    events = collections.deque(maxlen=keep)
+    next_token = None
+    while True:
+        page, next_token = yield from filter_events_page_requests(
+            log_group, start_time, end_time, filter_pattern, next_token
+        )
+        events.extend(page)
+        if not next_token:
+            return list(events)
+
+
+def read_range_requests(
+    log_group,
+    start_time,
+    end_time=None,
+    cache=None,
+    offline=False,
+    filter_pattern=None,
+    keep=None,
+):
+    """Return the events in a log group between start_time and end_time, using the local cache if there is one.
+
+    The cache holds every event in a time range, so it isn't used for filtered reads.
+    """
+    if cache is None or filter_pattern:
+        return (
+            yield from filter_range_requests(
+                log_group, start_time, end_time, filter_pattern, keep
+            )
+        )
+    events = yield from cache.events_requests(
+        filter_range_requests, log_group, start_time, end_time, offline
+    )
+    return events[-keep:] if keep else events
+
+
+def last_range_events_requests(
+    log_group, start_time, end_time, num, cache=None, offline=False, filter_pattern=None
+):
+    """Return the last num events in a log group between start_time and end_time (both inclusive).
+
+    A range with more than a page of events is split and its newest parts are read first, so finding the last few
+    events after a busy period doesn't page through the whole period.
+    """
+    cached = cache is not None and not filter_pattern
+    if cached and (offline or cache.covers(log_group, start_time, end_time)):
+        return (
+            yield from read_range_requests(
+                log_group, start_time, end_time, cache, offline, keep=num
+            )
+        )
+    page, next_token = yield from filter_events_page_requests(
+        log_group, start_time, end_time, filter_pattern
+    )
+    if not next_token:
+        if cached:
+            cache.add(log_group, start_time, end_time, page)
+        return page[-num:]
+    if end_time - start_time < MIN_SLICE_MS:
+        return (
+            yield from read_range_requests(
+                log_group, start_time, end_time, cache, offline, filter_pattern, num
+            )
+        )
+    chunks = []
+    found = 0
+    for part_start, part_end in reversed(
+        split_range(start_time, end_time, SLICE_SPLIT)
+    ):
+        chunk = yield from last_range_events_requests(
+            log_group, part_start, part_end, num - found, cache, offline, filter_pattern
+        )
+        chunks.append(chunk)
+        found += len(chunk)
+        if found >= num:
+            break
+    events = [event for chunk in reversed(chunks) for event in chunk]
+    events.sort(key=lambda e: e["timestamp"])
+    return events[-num:]
+
+
+def last_filtered_events_requests(
+    log_group, num, cache=None, offline=False, filter_pattern=None
+):
+    """Find the last num events in a log group by searching backwards in growing time windows."""
+    if offline:
+        floor = cache.store(log_group).oldest
+        if floor is None:
             return []
+    else:
+        floor = yield from log_group_creation_time_requests(log_group)
+    end_time = now_ms()
+    start_time = end_time + 1
+    window = INITIAL_WINDOW_MS
+    chunks = []
+    found = 0
+    while found < num and start_time > floor:
+        start_time = max(start_time - window, floor)
+        chunk = yield from last_range_events_requests(
+            log_group,
+            start_time,
+            end_time,
+            num - found,
+            cache,
+            offline,
+            filter_pattern,
+        )
+        chunks.append(chunk)
+        found += len(chunk)
+        end_time = start_time - 1
+        window *= WINDOW_GROWTH
+    events = [event for chunk in reversed(chunks) for event in chunk]
+    events.sort(key=lambda e: e["timestamp"])
+    return events
 
-    def get_events(log_group, log_streams, start_time=0):
-        all_events = []
-        pool = eventlet.greenpool.GreenPool(5)
-        # for log_stream in log_streams:
-        #     events = cwl.get_log_events(
-        #         logGroupName=log_group,
-        #         logStreamName=log_stream,
-        #         limit=num,
-        #         startTime=start_time
-        #     )
-        for events in pool.starmap(
-            get_stream_events,
-            [(log_group, log_stream, num, start_time) for log_stream in log_streams],
+
+def events_since_requests(
+    log_group, since, cache=None, offline=False, filter_pattern=None
+):
+    events = yield from read_range_requests(
+        log_group, since, None, cache, offline, filter_pattern
+    )
+    events.sort(key=lambda e: e["timestamp"])
+    return events
+
+
+def split_range(start_time, end_time, parts):
+    """Split start_time to end_time (inclusive) into at most `parts` contiguous ranges."""
+    size = max(1, (end_time - start_time + 1) // parts)
+    ranges = []
+    while start_time <= end_time:
+        slice_end = end_time if len(ranges) == parts - 1 else start_time + size - 1
+        ranges.append((start_time, min(slice_end, end_time)))
+        start_time = slice_end + 1
+    return ranges
+
+
+class SliceExporter(object):
+    """Reads the events in a time range of some log groups as concurrently read time slices.
+
+    A slice which has more than one page of events is dense, so rather than paging through it serially the part of it
+    after the first page is split into SLICE_SPLIT smaller slices which are read concurrently. Slices are read with
+    the engine's traverse, so they are started as soon as they are known about, throttling lowers the concurrency
+    limit rather than failing the export, and each log group's events are yielded in order as its slices finish.
+    """
+
+    def __init__(self, api, filter_pattern=None):
+        self.api = api
+        self.filter_pattern = filter_pattern
+        self.slices = 0
+        self.splits = 0
+
+    def read_slice_requests(self, item):
+        """Read a (log_group, start_time, end_time) slice. Returns its events and the slices of the rest of it."""
+        log_group, start_time, end_time = item
+        self.slices += 1
+        events = []
+        next_token = None
+        while True:
+            page, next_token = yield from filter_events_page_requests(
+                log_group, start_time, end_time, self.filter_pattern, next_token
+            )
+            events.extend(page)
+            if not next_token:
+                return events, []
+            # FilterLogEvents pages through a range in time order, so everything before the newest timestamp in the
+            # events so far has been read. The rest of the slice, starting from that timestamp, is read as smaller
+            # slices.
+            if not events or end_time - start_time < MIN_SLICE_MS:
+                continue
+            last = max(e["timestamp"] for e in events)
+            if last == events[0]["timestamp"]:
+                continue
+            self.splits += 1
+            events = [e for e in events if e["timestamp"] < last]
+            events.sort(key=lambda e: e["timestamp"])
+            return (
+                events,
+                [
+                    (log_group, s, e)
+                    for s, e in split_range(last, end_time, SLICE_SPLIT)
+                ],
+            )
+
+    def batches(self, log_groups, start_time, end_time, slices):
+        """Yield (log_group, events) for every event in log_groups from start_time to end_time (inclusive).
+
+        Each log group's batches come oldest first, each as soon as every slice before it has been read.
+        """
+        roots = [
+            (log_group, s, e)
+            for log_group in log_groups
+            for s, e in split_range(start_time, end_time, slices)
+        ]
+        # The slices of each log group which haven't been yielded yet, by start time. A slice's children start after
+        # it, so the first slice of a group is always either read or still being read.
+        waiting = {log_group: [] for log_group in log_groups}
+        for log_group, s, e in roots:
+            heapq.heappush(waiting[log_group], (s, e))
+        read = {}
+        for (log_group, s, e), (events, children) in self.api.traverse(
+            self.read_slice_requests, roots, lambda item, result: result[1]
         ):
-            all_events.extend(events)
-        all_events.sort(key=lambda e: e["timestamp"])
-        return all_events
+            read[log_group, s, e] = events
+            for _, child_start, child_end in children:
+                heapq.heappush(waiting[log_group], (child_start, child_end))
+            heap = waiting[log_group]
+            while heap and (log_group,) + heap[0] in read:
+                yield log_group, read.pop((log_group,) + heapq.heappop(heap))
+
+    def events(self, log_group, start_time, end_time, slices):
+        """Yield every event in log_group from start_time to end_time (inclusive), oldest first."""
+        for _, events in self.batches([log_group], start_time, end_time, slices):
+            for event in events:
+                yield event
+
+
+EXPORT_FIELDS = ("timestamp", "logStreamName", "eventId", "ingestionTime", "message")
+
+
+def export_path(output_dir, log_group):
+    return os.path.join(
+        output_dir, "%s.jsonl.gz" % (log_group.strip("/").replace("/", "_"),)
+    )
 
-    events = get_events(log_group, log_streams)
 
-    def print_events(events):
-        for e in events[-num:]:
+def export_to_files(exporter, log_groups, start_time, end_time, slices, output_dir):
+    """Write each log group's events to a file in output_dir, reading every log group at the same time.
+
+    Files are written under a temporary name and only renamed into place once the export has succeeded.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+    counts = collections.Counter()
+    try:
+        for log_group in log_groups:
+            files[log_group] = gzip.open(
+                export_path(output_dir, log_group) + ".tmp", "wt"
+            )
+        for log_group, events in exporter.batches(
+            log_groups, start_time, end_time, slices
+        ):
+            f = files[log_group]
+            for event in events:
+                f.write(json.dumps({k: event[k] for k in EXPORT_FIELDS if k in event}))
+                f.write("\n")
+            counts[log_group] += len(events)
+        for f in files.values():
+            f.close()
+        for log_group in log_groups:
+            path = export_path(output_dir, log_group)
+            os.replace(path + ".tmp", path)
+            print("Wrote %d events to %s" % (counts[log_group], path), file=sys.stderr)
+    except BaseException:
+        for log_group, f in files.items():
+            f.close()
+            try:
+                os.remove(export_path(output_dir, log_group) + ".tmp")
+            except FileNotFoundError:
+                pass
+        raise
+
+
+def export(
+    api,
+    log_groups,
+    print_events,
+    start_time,
+    end_time,
+    slices,
+    output_dir=None,
+    filter_pattern=None,
+    stats=False,
+):
+    exporter = SliceExporter(api, filter_pattern)
+    try:
+        if output_dir:
+            export_to_files(
+                exporter, log_groups, start_time, end_time, slices, output_dir
+            )
+        else:
+            print_events(
+                merge_events(
+                    [
+                        exporter.events(log_group, start_time, end_time, slices)
+                        for log_group in log_groups
+                    ]
+                )
+            )
+    finally:
+        if stats:
+            print(
+                "stats: slices=%d splits=%d %s"
+                % (exporter.slices, exporter.splits, api.controller.format_stats()),
+                file=sys.stderr,
+            )
+
+
+class InsightsQuery(object):
+    """A CloudWatch Logs Insights query which is polled until it finishes.
+
+    Rows which identify a log event (they have an @ptr field) are returned as soon as they show up in the results.
+    Aggregated rows can change while the query runs so they are only returned once it is complete.
+    """
+
+    def __init__(self, query_string, log_groups, start_time, end_time, label=None):
+        self.query_string = query_string
+        self.log_groups = log_groups
+        self.start_time = start_time
+        self.end_time = end_time
+        self.label = label
+        self.query_id = None
+        self.status = None
+        self.statistics = {}
+        self._seen = set()
+
+    @property
+    def done(self):
+        return self.status in QUERY_DONE_STATUSES
+
+    def start_requests(self):
+        response = (
+            yield "start_query",
+            {
+                "logGroupNames": self.log_groups,
+                "startTime": self.start_time // 1000,
+                "endTime": self.end_time // 1000,
+                "queryString": self.query_string,
+            },
+        )
+        self.query_id = response["queryId"]
+        self.status = "Scheduled"
+
+    def stop_requests(self):
+        if self.query_id is not None and not self.done:
+            try:
+                yield "stop_query", {"queryId": self.query_id}
+            except botocore.exceptions.ClientError:
+                pass
+
+    def poll_requests(self):
+        """Get the query's results, returning the rows which haven't been returned before."""
+        response = yield "get_query_results", {"queryId": self.query_id}
+        self.status = response["status"]
+        self.statistics = response.get("statistics", {})
+        rows = []
+        for result in response["results"]:
+            row = collections.OrderedDict(
+                (field["field"], field.get("value")) for field in result
+            )
+            ptr = row.pop("@ptr", None)
+            if ptr is None:
+                if self.status != "Complete":
+                    continue
+                key = tuple(row.items())
+            else:
+                key = ptr
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+            rows.append(row)
+        return rows
+
+
+def run_queries(api, query_strings, log_groups, start_time, end_time, stats=False):
+    """Run each query over all of the log groups at the same time, printing rows as they arrive.
+
+    The queries are started together and then polled together, every poll being a single map over the queries which
+    are still running.
+    """
+    queries = [
+        InsightsQuery(
+            query_string,
+            log_groups[batch_start : batch_start + QUERY_LOG_GROUPS],
+            start_time,
+            end_time,
+            str(i + 1) if len(query_strings) > 1 else None,
+        )
+        for i, query_string in enumerate(query_strings)
+        for batch_start in range(0, len(log_groups), QUERY_LOG_GROUPS)
+    ]
+    interval = AdaptiveInterval(QUERY_MIN_INTERVAL, QUERY_MAX_INTERVAL)
+    try:
+        api.map(lambda query: query.start_requests(), queries)
+        running = queries
+        while running:
+            interval.sleep()
+            num_rows = 0
+            for query, rows in zip(
+                running, api.map(lambda query: query.poll_requests(), running)
+            ):
+                for row in rows:
+                    print(
+                        "%s%s"
+                        % (
+                            "[%s] " % (query.label,) if query.label else "",
+                            " ".join("%s=%s" % (k, v) for k, v in row.items()),
+                        )
+                    )
+                num_rows += len(rows)
+            interval.update(num_rows)
+            running = [query for query in running if not query.done]
+    finally:
+        api.map(lambda query: query.stop_requests(), queries)
+    for query in queries:
+        if query.status != "Complete":
+            print(
+                "Query %r over %s finished with status %s"
+                % (query.query_string, ", ".join(query.log_groups), query.status),
+                file=sys.stderr,
+            )
+        if stats:
+            print(
+                "stats: query=%r status=%s %s"
+                % (
+                    query.query_string,
+                    query.status,
+                    " ".join(
+                        "%s=%s" % (k, v) for k, v in sorted(query.statistics.items())
+                    ),
+                ),
+                file=sys.stderr,
+            )
+
+
+class GroupCursor(object):
+    """Tracks the newest timestamp read from a log group with FilterLogEvents.
+
+    Each read starts LOOKBACK_MS before the newest timestamp, which makes sure we don't lose events which are ingested
+    after newer ones from other streams or arrive later in the same millisecond. The caller drops the ones that have
+    already been output.
+    """
+
+    def __init__(self, log_group, start_time, filter_pattern=None):
+        self.log_group = log_group
+        self.start_time = start_time
+        self.filter_pattern = filter_pattern
+
+    def read_requests(self, num):
+        events = []
+        next_token = None
+        while True:
+            page, next_token = yield from filter_events_page_requests(
+                self.log_group,
+                self.start_time - LOOKBACK_MS,
+                filter_pattern=self.filter_pattern,
+                next_token=next_token,
+            )
+            events.extend(page)
+            if not next_token:
+                break
+        events.sort(key=lambda e: e["timestamp"])
+        if events:
+            self.start_time = max(self.start_time, events[-1]["timestamp"])
+        return events
+
+
+def read_cursor_requests(cursor, num, seen):
+    """Read a cursor's events, dropping the ones already seen. Errors other than throttling give no events."""
+    try:
+        events = yield from cursor.read_requests(num)
+    except botocore.exceptions.ClientError:
+        return []
+    return [e for e in events if seen.add(event_id(e))]
+
+
+def merge_events(event_lists):
+    """Merge lists of events which are each already sorted into a single stream ordered by timestamp."""
+    return heapq.merge(*event_lists, key=lambda e: e["timestamp"])
+
+
+def get_events(api, cursors, num, seen):
+    return merge_events(
+        api.map(lambda cursor: read_cursor_requests(cursor, num, seen), cursors)
+    )
+
+
+class MessageFilter(object):
+    """A client-side filter and field projection for log messages, compiled once and applied to every event.
+
+    Calling it with a message returns the text to output, or None if the event should be skipped. Each message is
+    matched against the regex and parsed as JSON at most once.
+    """
+
+    def __init__(self, pattern=None, fields=None):
+        self.regex = re.compile(pattern) if pattern else None
+        self.fields = (
+            [(field, tuple(field.split("."))) for field in fields] if fields else None
+        )
+        self.fields_from_regex = bool(
+            self.fields
+            and self.regex
+            and all(field in self.regex.groupindex for field, _ in self.fields)
+        )
+        self._decoder = json.JSONDecoder()
+
+    def parse_json(self, message):
+        # Many loggers put a prefix, such as a timestamp and request id, before the JSON object.
+        start = message.find("{")
+        if start == -1:
+            return None
+        try:
+            return self._decoder.raw_decode(message, start)[0]
+        except ValueError:
+            return None
+
+    def project(self, doc):
+        values = []
+        found = False
+        for field, path in self.fields:
+            value = doc
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    value = None
+                    break
+                value = value[key]
+            if value is None:
+                values.append("%s=-" % (field,))
+                continue
+            found = True
+            if not isinstance(value, str):
+                value = json.dumps(value)
+            values.append("%s=%s" % (field, value))
+        return " ".join(values) if found else None
+
+    def __call__(self, message):
+        match = None
+        if self.regex is not None:
+            match = self.regex.search(message)
+            if match is None:
+                return None
+        if self.fields is None:
+            return message.rstrip("\n")
+        if self.fields_from_regex:
+            return self.project(match.groupdict())
+        doc = self.parse_json(message)
+        if not isinstance(doc, dict):
+            return None
+        return self.project(doc)
+
+
+class EventPrinter(object):
+    def __init__(self, show_group=False, message_filter=None):
+        self.show_group = show_group
+        self.message_filter = message_filter
+
+    def __call__(self, events):
+        """Print events, returning how many were read."""
+        count = 0
+        for e in events:
+            count += 1
+            if self.message_filter is None:
+                text = e["message"].rstrip("\n")
+            else:
+                text = self.message_filter(e["message"])
+                if text is None:
+                    continue
             print(
                 "%s %s %s"
                 % (
                     datetime.datetime.fromtimestamp(e["timestamp"] / 1000.0),
-                    e["log_stream"],
-                    e["message"].rstrip("\n"),
+                    "%s %s" % (e["log_group"], e["log_stream"])
+                    if self.show_group
+                    else e["log_stream"],
+                    text,
                 )
             )
+        return count
+
+
+def print_stats(interval, api, extra=""):
+    print(
+        "stats: %s %s%s"
+        % (interval.format_stats(), api.controller.format_stats(), extra),
+        file=sys.stderr,
+    )
+    metrics.print_stats()
+
 
+def follow_events(
+    api,
+    cursors,
+    num,
+    seen,
+    interval,
+    print_events,
+    stats,
+    extra_stats=None,
+    before_poll=None,
+):
+    """Poll the cursors forever, waiting between polls as long as interval decides."""
+    last_stats = time.time()
+    try:
+        while True:
+            try:
+                interval.sleep()
+                if before_poll is not None:
+                    before_poll()
+                throttles = api.controller.throttles
+                events = print_events(get_events(api, list(cursors()), num, seen))
+                # The API engine retries throttled reads, but they still mean we should poll less often.
+                if api.controller.throttles > throttles:
+                    interval.throttled()
+                interval.update(events)
+                if stats and time.time() - last_stats >= STATS_INTERVAL:
+                    last_stats = time.time()
+                    print_stats(interval, api, extra_stats() if extra_stats else "")
+            except Exception:
+                traceback.print_exc()
+    finally:
+        if stats:
+            print_stats(interval, api, extra_stats() if extra_stats else "")
+
+
+def offline_call(operation, **kwargs):
+    raise RuntimeError("Can't call %s when offline" % (operation,))
+
+
+def tail_filtered(
+    log_groups,
+    num,
+    follow,
+    print_events,
+    interval,
+    api,
+    stats,
+    since=None,
+    cache=None,
+    offline=False,
+    filter_pattern=None,
+):
+    def read_groups(requests_func):
+        if api is None:
+            # Offline reads only come from the cache, so there is no engine and no calls to make.
+            return [
+                concurrency.run_requests(requests_func(log_group), offline_call)
+                for log_group in log_groups
+            ]
+        return api.map(requests_func, log_groups)
+
+    if since is None:
+        group_events = read_groups(
+            lambda log_group: last_filtered_events_requests(
+                log_group, num, cache, offline, filter_pattern
+            )
+        )
+        print_events(collections.deque(merge_events(group_events), maxlen=num))
+    else:
+        group_events = read_groups(
+            lambda log_group: events_since_requests(
+                log_group, since, cache, offline, filter_pattern
+            )
+        )
+        print_events(merge_events(group_events))
+
+    if not follow:
+        return
+
+    seen = EventIdCache()
+    cursors = []
+    for log_group, events in zip(log_groups, group_events):
+        for event in events:
+            seen.add(event["eventId"])
+        cursors.append(
+            GroupCursor(
+                log_group,
+                events[-1]["timestamp"] if events else now_ms(),
+                filter_pattern,
+            )
+        )
+    follow_events(api, lambda: cursors, num, seen, interval, print_events, stats)
+
+
+def tail_streams(
+    log_groups,
+    num,
+    follow,
+    print_events,
+    interval,
+    api,
+    stats,
+    stream_ttl,
+    max_streams,
+    since=None,
+):
+    streams = StreamManager(log_groups, stream_ttl, max_streams, start_time=since)
+    streams.refresh(api)
+    seen = EventIdCache()
+
+    events = collections.deque(
+        get_events(api, streams.values(), num, seen),
+        maxlen=num if since is None else None,
+    )
     print_events(events)
-    # print(events[-1].keys())
 
-    if not args["--follow"]:
+    if not follow:
         return
 
+    stream_interval = AdaptiveInterval(
+        max(interval.floor, MIN_STREAM_REFRESH_INTERVAL), interval.ceiling
+    )
+
+    def refresh_streams():
+        added = 0
+        throttles = api.controller.throttles
+        try:
+            added = streams.refresh(api)
+        except botocore.exceptions.ClientError:
+            pass
+        # The engine retries throttled listings, but they still mean we should list less often.
+        if api.controller.throttles > throttles:
+            stream_interval.throttled()
+        stream_interval.update(added)
+
     def log_stream_updater():
         while True:
-            try:
-                log_streams.update(get_log_streams(log_group))
-            except botocore.exceptions.ClientError:
-                time.sleep(5)
-            time.sleep(5)
+            stream_interval.sleep()
+            refresh_streams()
 
-    eventlet.spawn(log_stream_updater)
+    last_refresh = [time.time()]
 
-    while True:
-        try:
-            time.sleep(1)
-            new_events = get_events(
-                log_group, log_streams, start_time=events[-1]["timestamp"] + 1
-            )
-            if new_events:
-                events = new_events
-                print_events(events)
-            # else:
-            #     print('...')
-        except Exception:
-            traceback.print_exc()
+    def refresh_streams_if_due():
+        if time.time() - last_refresh[0] >= stream_interval.current:
+            last_refresh[0] = time.time()
+            refresh_streams()
+
+    before_poll = None
+    if eventlet.patcher.is_monkey_patched("time"):
+        eventlet.spawn(log_stream_updater)
+    else:
+        # Without eventlet's patching the updater would never get to run, so streams are refreshed between polls.
+        before_poll = refresh_streams_if_due
+
+    follow_events(
+        api,
+        streams.values,
+        num,
+        seen,
+        interval,
+        print_events,
+        stats,
+        lambda: " streams=%d retired_streams=%d stream_refresh_interval=%.2fs"
+        % (len(streams), streams.retired, stream_interval.current),
+        before_poll,
+    )
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    num = int(args["--number"])
+    engine = args["--engine"]
+    if engine not in ENGINES:
+        sys.exit("--engine must be one of %s" % (", ".join(ENGINES),))
+
+    if (args["export"] or args["query"]) and (args["--follow"] or args["--offline"]):
+        sys.exit("export and query can't be used with --follow or --offline")
+    if args["--offline"] and (
+        args["--follow"]
+        or args["--no-cache"]
+        or args["--filter-pattern"]
+        or engine != "filter"
+    ):
+        sys.exit(
+            "--offline needs the filter engine and can't be used with --follow, --no-cache or --filter-pattern"
+        )
+    if args["--filter-pattern"] and engine != "filter":
+        sys.exit("--filter-pattern needs the filter engine")
+    try:
+        since = parse_time(args["--since"]) if args["--since"] else None
+        start_time = parse_time(args["--start"]) if args["--start"] else None
+        end_time = parse_time(args["--end"]) if args["--end"] else now_ms()
+    except ValueError as exc:
+        sys.exit(str(exc))
+
+    cache = None
+    if engine == "filter" and not args["--no-cache"]:
+        cache = log_cache.LogCache(
+            args["--cache-dir"], int(args["--cache-size"]) * 1024 * 1024
+        )
+
+    interval = AdaptiveInterval(
+        float(args["--min-interval"]), float(args["--max-interval"])
+    )
+
+    metrics.setup(args["--prometheus-file"])
+    # Offline runs only read the cache, so they don't need credentials or a region.
+    api = (
+        None
+        if args["--offline"]
+        else clients.get_engine("logs", args["--asyncio"], args["--profile"])
+    )
+    try:
+        if args["--prefix"] and args["--offline"]:
+            log_groups = [
+                store.log_group
+                for store in cache.all_stores()
+                if store.log_group.startswith(args["--prefix"])
+            ]
+            if not log_groups:
+                sys.exit(
+                    "No cached log groups found with prefix %s" % (args["--prefix"],)
+                )
+        elif args["--prefix"]:
+            log_groups = api.run(log_groups_requests(args["--prefix"]))
+            if not log_groups:
+                sys.exit("No log groups found with prefix %s" % (args["--prefix"],))
+        else:
+            log_groups = args["<log_group>"]
+        print_events = EventPrinter(
+            len(log_groups) > 1,
+            MessageFilter(
+                args["--match"],
+                args["--fields"].split(",") if args["--fields"] else None,
+            )
+            if args["--match"] or args["--fields"]
+            else None,
+        )
+        if args["query"]:
+            run_queries(
+                api, args["--query"], log_groups, start_time, end_time, args["--stats"]
+            )
+        elif args["export"]:
+            # The controller still lowers the limit if the export is throttled. Its maximum starts out as the size of
+            # the client's connection pool, and going past that would open a new connection for every extra call.
+            api.controller.maximum = min(
+                int(args["--concurrency"]), api.controller.maximum
+            )
+            api.controller.limit = min(api.controller.limit, api.controller.maximum)
+            export(
+                api,
+                log_groups,
+                print_events,
+                start_time,
+                end_time,
+                int(args["--slices"]),
+                args["--output-dir"],
+                args["--filter-pattern"],
+                args["--stats"],
+            )
+        elif engine == "filter":
+            try:
+                tail_filtered(
+                    log_groups,
+                    num,
+                    args["--follow"],
+                    print_events,
+                    interval,
+                    api,
+                    args["--stats"],
+                    since,
+                    cache,
+                    args["--offline"],
+                    args["--filter-pattern"],
+                )
+            finally:
+                if cache is not None:
+                    cache.evict()
+        else:
+            tail_streams(
+                log_groups,
+                num,
+                args["--follow"],
+                print_events,
+                interval,
+                api,
+                args["--stats"],
+                int(args["--stream-ttl"]) * 1000,
+                int(args["--max-streams"]),
+                since,
+            )
+    finally:
+        if api is not None:
+            api.close()
+        # Following prints the API metrics with the rest of its stats.
+        if args["--stats"] and not args["--follow"]:
+            metrics.print_stats()
 
 
 if __name__ == "__main__":
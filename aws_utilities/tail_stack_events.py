@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 """Usage:
-    tail_stack_events.py [--follow] [--number=<n>] [--depth=<d>] [--max-column-length=<x>] [--profile=<profile>] <stack>
-    tail_stack_events.py [--postmortem] [--find-last-failure] [--show-all-failures] [--max-column-length=<x>] [--profile=<profile>] <stack>
+    tail_stack_events.py [--follow] [--stats] [--prometheus-file=<path>] [--number=<n>] [--depth=<d>] [--max-column-length=<x>] [--profile=<profile>] [--asyncio] <stack>
+    tail_stack_events.py [--postmortem] [--find-last-failure] [--show-all-failures] [--stats] [--prometheus-file=<path>] [--max-column-length=<x>] [--profile=<profile>] [--asyncio] <stack>
+    tail_stack_events.py --timings [--top=<n>] [--trace-file=<path>] [--durations-file=<path>] [--stats] [--prometheus-file=<path>] [--max-column-length=<x>] [--profile=<profile>] [--asyncio] <stack>
 
 Options:
     -f --follow                     Follow the stack events and output new ones as they are received.
@@ -14,184 +15,272 @@ Options:
     -x <x> --max-column-length=<x>  The maximum column length for tabular output.
                                     Defaults to 200 for postmortem, 40 otherwise.
     --show-all-failures             Show all failures for the stack update, not just the one that caused the rollback.
+    -t --timings                    Show how long each resource took in the last operation on the stack and the stacks
+                                    nested in it, the slowest resources and the chain of resources the operation
+                                    waited on.
+    --top=<n>                       The number of slowest resources to show with --timings. [default: 20]
+    --trace-file=<path>             With --timings, also write the timeline to this file in the Chrome trace event
+                                    format, which chrome://tracing, Perfetto and speedscope can show.
+    --durations-file=<path>         Where --timings adds the durations of the resource changes it reads, for
+                                    pending_stack_resources to estimate from.
+                                    Defaults to ~/.cache/aws_utilities/durations.json.
+    --stats                         Print the resident memory, the amount of tracked state, the API concurrency and
+                                    the calls, retries, throttles, bytes and latency of each API operation to stderr
+                                    every few minutes while following and on exit.
+    --prometheus-file=<path>        Keep the API metrics in this file in the Prometheus text format, e.g. for
+                                    node_exporter's textfile collector.
+    --asyncio                       Make API calls with aiobotocore on an asyncio event loop instead of with eventlet.
     <stack>                         The top-level stack to get events for.
 """
 import collections
+import datetime
+import heapq
+import json
 import logging
-import math
+import os
 import sys
 import time
 import traceback
 
-import eventlet
+if __name__ == "__main__":
+    # Running the script directly rather than through its console script, so patch before botocore is imported.
+    from aws_utilities import entry_points
 
-eventlet.monkey_patch()
+    entry_points.setup()
 
-import ansiwrap
 import botocore.exceptions
-import boto3
 import colorama
 import docopt
-import eventlet.greenpool
-import tenacity
-
 
-STACK_TYPE = "AWS::CloudFormation::Stack"
-ELLIPSIS = u"\u2026"
+from aws_utilities import clients
+from aws_utilities import cloudformation
+from aws_utilities import durations
+from aws_utilities import metrics
+from aws_utilities import table as tables
+
+try:
+    import resource
+except ImportError:
+    # resource is only available on Unix.
+    HAVE_RESOURCE = False
+else:
+    HAVE_RESOURCE = True
+
+
+STACK_TYPE = cloudformation.STACK_TYPE
+
+StackCursor = cloudformation.StackCursor
+# Every stack status except DELETE_COMPLETE, which we never need to know about and would add pages of deleted stacks
+# to every ListStacks call.
+LIVE_STACK_STATUSES = [
+    "CREATE_IN_PROGRESS",
+    "CREATE_FAILED",
+    "CREATE_COMPLETE",
+    "ROLLBACK_IN_PROGRESS",
+    "ROLLBACK_FAILED",
+    "ROLLBACK_COMPLETE",
+    "DELETE_IN_PROGRESS",
+    "DELETE_FAILED",
+    "UPDATE_IN_PROGRESS",
+    "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_COMPLETE",
+    "UPDATE_FAILED",
+    "UPDATE_ROLLBACK_IN_PROGRESS",
+    "UPDATE_ROLLBACK_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "REVIEW_IN_PROGRESS",
+    "IMPORT_IN_PROGRESS",
+    "IMPORT_COMPLETE",
+    "IMPORT_ROLLBACK_IN_PROGRESS",
+    "IMPORT_ROLLBACK_FAILED",
+    "IMPORT_ROLLBACK_COMPLETE",
+]
+
+# While following, event ids are remembered for this long past the newest event output to stop them being output
+# twice. Older events are never output so their ids don't need to be kept.
+DEDUPE_WINDOW = datetime.timedelta(minutes=10)
+STATS_INTERVAL = 300
 
 LOG = logging.getLogger(__name__)
 
 
-def retry(func):
-    tretry = tenacity.retry(
-        wait=(tenacity.wait_random_exponential(multiplier=1, min=0.1, max=10)),
-        after=tenacity.after_log(LOG, logging.WARNING),
-    )
-
-    def log_exc(*a, **k):
-        try:
-            return func(*a, **k)
-        except Exception:
-            LOG.exception("Exception calling %r" % (func,))
-            raise
-
-    return tretry(log_exc)
+class RecentEventIds(object):
+    """The ids of the events output within DEDUPE_WINDOW of the newest one."""
 
+    def __init__(self, window=DEDUPE_WINDOW):
+        self.window = window
+        self._ids = set()
+        self._order = collections.deque()
 
-class Column(object):
-    def __init__(self, mvl, ml):
-        self.max_value_length = mvl
-        self.max_length = ml
+    def __contains__(self, event_id):
+        return event_id in self._ids
 
+    def __len__(self):
+        return len(self._ids)
 
-@retry
-def get_stack(stack_name_or_arn):
-    cf = boto3.resource("cloudformation")
-    stack = cf.Stack(stack_name_or_arn)
-    # Switch to the ARN if a stack name was passed in
-    if stack.stack_id != stack_name_or_arn:
-        stack = cf.Stack(stack.stack_id)
-    return stack
+    def add(self, event):
+        if event.id in self._ids:
+            return
+        self._ids.add(event.id)
+        self._order.append((event.timestamp, event.id))
+        cutoff = event.timestamp - self.window
+        while self._order and self._order[0][0] < cutoff:
+            self._ids.discard(self._order.popleft()[1])
 
 
-# TODO: make the retries per-api-call rather than on this function to reduce repeated API calls
-@retry
-def get_nested_stacks(stack_name_or_arn, depth=None, status_check=None):
-    stack = get_stack(stack_name_or_arn)
-    stacks = {stack.stack_id: stack}
-    if depth == 0:
-        return stacks
-    for sub in stack.resource_summaries.all():
-        if sub.resource_type != STACK_TYPE:
-            continue
-        if status_check is not None and status_check(sub.resource_status):
-            stacks.update(
-                get_nested_stacks(
-                    sub.physical_resource_id,
-                    depth - 1 if depth is not None else None,
-                    status_check,
-                )
-            )
-    return stacks
-
-
-def get_stack_events(stack, limit=5, _mem={}):
-    # TODO: preload _mem with the timestamp of the first event in the parent stack that caused us to add the stack
-    pages = stack.events.pages()
-    events = next_page(pages)
-    if not events:
-        if stack.stack_id in _mem:
-            del _mem[stack.stack_id]
-        return []
-    events.sort(key=lambda e: e.timestamp)
-    if stack.stack_id in _mem:
-        while events[0].timestamp > _mem[stack.stack_id]:
-            more = list(next(pages))
-            if not more:
-                break
-            more.sort(key=lambda e: e.timestamp)
-            events = more + events
-    _mem[stack.stack_id] = events[-1].timestamp
-    if stack.stack_id not in _mem:
-        return events[-limit:]
-    return events
+def resident_memory():
+    """Return the resident set size of this process in bytes, or None if it can't be found."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        pass
+    if not HAVE_RESOURCE:
+        return None
+    # ru_maxrss is the peak rather than the current size. It is in bytes on macOS and kilobytes elsewhere.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def print_stats(engine, table, stacks=None, outputted=None, detector=None):
+    rss = resident_memory()
+    print(
+        "stats: rss=%s%s%s %s %s"
+        % (
+            "%.1fMiB" % (rss / 1024.0 / 1024.0) if rss is not None else "unknown",
+            " tracked_stacks=%d dedupe_ids=%d" % (len(stacks), len(outputted))
+            if stacks is not None
+            else "",
+            " skipped_polls=%d" % (detector.skipped,) if detector is not None else "",
+            engine.controller.format_stats(),
+            table.format_stats(),
+        ),
+        file=sys.stderr,
+    )
+    metrics.print_stats()
+
+
+def list_nested_stacks_requests(stack_id):
+    """Return the resources for the stacks nested directly in a stack."""
+    resources = yield from cloudformation.list_stack_resources_requests(stack_id)
+    return [
+        resource
+        for resource in resources
+        if resource.resource_type == STACK_TYPE and resource.physical_resource_id
+    ]
+
+
+def get_nested_stacks(engine, stack_id, depth=None, status_check=None, graph=None):
+    """Return the ids of a stack and the stacks nested in it down to depth levels (or all levels if depth is None).
+
+    The tree is walked breadth-first and the stacks on each level are listed concurrently, so it takes one round of
+    calls per level rather than one call per stack in turn. If status_check is given only nested stacks with a status
+    it returns True for, and the stacks below them, are included. Every nested stack found is added to graph.
+    """
+    stack_ids = [stack_id]
+    level = [stack_id]
+    while level and depth != 0:
+        next_level = []
+        for parent_id, nested in zip(
+            level, engine.map(list_nested_stacks_requests, level)
+        ):
+            for resource in nested:
+                if graph is not None:
+                    graph.add(resource.physical_resource_id, parent_id)
+                if status_check is None or status_check(resource.resource_status):
+                    next_level.append(resource.physical_resource_id)
+        stack_ids.extend(next_level)
+        level = next_level
+        if depth is not None:
+            depth -= 1
+    return stack_ids
+
+
+class StackChangeDetector(object):
+    """Works out which tracked stacks may have new events without asking each of them for events.
+
+    The status and LastUpdatedTime of every stack are listed with ListStacks, up to 100 stacks per call. Only stacks
+    which are in progress, whose status or LastUpdatedTime moved since the last check, or which haven't been polled
+    yet need their events fetched. Listing is only worth it while there are more tracked stacks than there are pages
+    of stacks in the account, otherwise every stack is simply polled.
+    """
+
+    def __init__(self, engine, graph=None):
+        self.engine = engine
+        self.graph = graph
+        self.pages = 1
+        self.skipped = 0
+        self._state = {}
+
+    def list_stacks(self):
+        summaries, pages = self.engine.run(
+            cloudformation.list_stacks_requests(LIVE_STACK_STATUSES)
+        )
+        self.pages = max(1, pages)
+        if self.graph is not None:
+            # The summaries cover every stack in the account, so only those nested in the tree are indexed.
+            for summary in summaries:
+                if summary.get("ParentId") in self.graph:
+                    self.graph.add(summary["StackId"], summary["ParentId"])
+        return {
+            summary["StackId"]: (summary["StackStatus"], summary.get("LastUpdatedTime"))
+            for summary in summaries
+        }
+
+    def changed(self, stacks):
+        """Return the ids of the stacks which need to be polled for events."""
+        if len(stacks) <= self.pages:
+            return set(stacks.keys())
+        states = self.list_stacks()
+        changed = set()
+        for stack_id, cursor in stacks.items():
+            state = states.get(stack_id)
+            if (
+                state is None
+                or "IN_PROGRESS" in state[0]
+                or state != self._state.get(stack_id)
+                or cursor.last_event_id is None
+            ):
+                changed.add(stack_id)
+        self._state = {stack_id: states.get(stack_id) for stack_id in stacks}
+        self.skipped += len(stacks) - len(changed)
+        return changed
 
 
-def get_events(stacks, limit=5):
-    all_events = []
-    pool = eventlet.greenpool.GreenPool(5)
+def get_events(engine, stacks, stack_ids=None):
+    """Poll the stacks, or only those in stack_ids, for new events."""
     remove_stacks = set()
+    event_lists = []
+    if stack_ids is None:
+        stack_ids = list(stacks.keys())
+    else:
+        stack_ids = [stack_id for stack_id in stacks if stack_id in stack_ids]
     for stack_id, events in zip(
-        list(stacks.keys()),
-        pool.starmap(get_stack_events, ((s, limit) for s in list(stacks.values()))),
+        stack_ids,
+        engine.map(lambda stack_id: stacks[stack_id].poll_requests(), stack_ids),
     ):
-        if not events:
+        if events is None:
             remove_stacks.add(stack_id)
             continue
-        all_events.extend(events)
+        event_lists.append(events)
     for stack_id in remove_stacks:
         del stacks[stack_id]
-    all_events.sort(key=lambda e: e.timestamp)
-    return all_events
+    # Each stack's events are already in order so they only need to be merged.
+    return list(heapq.merge(*event_lists, key=lambda e: e.timestamp))
 
 
-def update_columns(columns, events):
-    for event in events:
-        for column in columns.keys():
-            columns[column].max_value_length = max(
-                columns[column].max_value_length, len(str(getattr(event, column)))
-            )
+def update_stacks_from_events(stacks, events, main_stack, graph, max_depth=None):
+    """Start polling nested stacks which start updating and stop polling those which finish.
 
-
-def format_column(column_name, column, value):
-    text = str(value)
-    if column_name == "resource_status":
-        uvalue = value.upper()
-        if "FAIL" in uvalue:
-            color = colorama.Fore.RED
-        elif "ROLLBACK" in uvalue:
-            color = colorama.Fore.YELLOW
-        elif "IN_PROGRESS" in uvalue:
-            color = colorama.Fore.BLUE
-        elif uvalue == "DELETE_COMPLETE":
-            color = colorama.Fore.LIGHTBLACK_EX
-        elif "COMPLETE" in uvalue:
-            color = colorama.Fore.GREEN
-        else:
-            color = colorama.Fore.WHITE
-        text = "%s%s%s" % (color, value, colorama.Style.RESET_ALL)
-    if ansiwrap.ansilen(text) > column.max_length:
-        half_length = (column.max_length - 1) / 2.0
-        output_text = "%s%s%s" % (
-            text[: int(math.floor(half_length))],
-            ELLIPSIS,
-            text[-int(math.ceil(half_length)) :],
-        )
-    else:
-        output_text = text
-    padding = " " * max(
-        0,
-        min(column.max_value_length, column.max_length) - ansiwrap.ansilen(output_text),
-    )
-    return "%s%s" % (padding, output_text)
-
-
-def output_events(columns, events):
-    for e in events:
-        fmt = "  ".join("%s" for _ in columns.values())
-        print(
-            fmt
-            % tuple([format_column(n, c, getattr(e, n)) for n, c in columns.items()])
-        )
-
-
-def update_stacks_from_events(stacks, events, main_stack, max_depth=None):
-    cf = boto3.resource("cloudformation")
+    Stacks deeper than max_depth below the main stack are left out, using their depth in graph.
+    """
     to_remove = set()
     to_add = set()
 
     # NOTE: Assuming that events are in proper order here
     for event in events:
+        graph.add_event(event)
         if event.resource_type == STACK_TYPE:
             if event.resource_status.endswith("COMPLETE"):
                 # print('Stack %s COMPLETE' % (event.physical_resource_id,))
@@ -214,56 +303,62 @@ def update_stacks_from_events(stacks, events, main_stack, max_depth=None):
 
     for stack_id in to_remove:
         if stack_id != main_stack.stack_id and stack_id in stacks:
-            if len(stacks) != 1:
-                del stacks[stack_id]
+            # A stack only finishes once everything nested in it has, so none of its subtree needs polling either.
+            for nested_id in graph.subtree(stack_id):
+                if nested_id in stacks and len(stacks) != 1:
+                    del stacks[nested_id]
             # else:
             #     print('Final stack COMPLETE')
     for stack_id in to_add:
-        if stack_id not in stacks and (
-            max_depth is None or len(stack_id.split("-")) - 1 <= max_depth
-        ):
-            stack = cf.Stack(stack_id)
-            # Force loading with a retry as it can incur a potentially-failing API call
-            retry(lambda: stack.stack_id)()
-            # try:
-            #     get_stack_events(stack, 1)
-            # except botocore.exceptions.ClientError:
-            #     continue
-            stacks[stack_id] = stack
-
-
-def do_tail_stack_events(main_stack, num, columns, headers, max_depth, follow):
-    stacks = get_nested_stacks(
-        main_stack.stack_id, status_check=lambda status: "IN_PROGRESS" in status
-    )
+        if stack_id not in stacks and graph.within(stack_id, max_depth):
+            stacks[stack_id] = StackCursor(stack_id)
+
+
+def do_tail_stack_events(
+    engine, main_stack, num, table, max_depth, follow, stats=False
+):
+    graph = cloudformation.StackGraph(main_stack.stack_id)
+    stacks = {
+        stack_id: StackCursor(stack_id)
+        for stack_id in get_nested_stacks(
+            engine,
+            main_stack.stack_id,
+            depth=max_depth,
+            status_check=lambda status: "IN_PROGRESS" in status,
+            graph=graph,
+        )
+    }
 
     print("Getting events...")
-    events = get_events(stacks, limit=num)
-    outputted = set(e.id for e in events)
-    update_columns(columns, events[-num:])
+    events = get_events(engine, stacks)
+    outputted = RecentEventIds()
+    for event in events:
+        outputted.add(event)
+    table.widen(events[-num:])
 
-    update_stacks_from_events(stacks, events, main_stack, max_depth=max_depth)
+    update_stacks_from_events(stacks, events, main_stack, graph, max_depth=max_depth)
 
-    output_events(columns, [headers])
-    output_events(columns, events[-num:])
+    table.write(events[-num:])
 
     last_event_timestamp = events[-1].timestamp
 
     if not follow:
         return
 
-    # TODO: Keep track of last updated timestamp for each stack and don't ask for more events
-    # if it hasn't changed?
-    # This would require updating the stack every time, though, which means adding another API call.
+    detector = StackChangeDetector(engine, graph)
+    last_stats = time.time()
 
     while True:
         try:
             time.sleep(5)
-            events = get_events(stacks)
+            if stats and time.time() - last_stats >= STATS_INTERVAL:
+                last_stats = time.time()
+                print_stats(engine, table, stacks, outputted, detector)
+            events = get_events(engine, stacks, detector.changed(stacks))
             new_events = []
             for event in events:
-                # Don't re-ouput events and don't output events older than the latest event shown (not doing this means
-                # we can get events from the previous stack updates, which we don't want).
+                # Don't re-ouput events and don't output events older than the latest event shown (not doing this
+                # means we can get events from the previous stack updates, which we don't want).
                 if event.id in outputted or event.timestamp < last_event_timestamp:
                     continue
                 new_events.append(event)
@@ -271,49 +366,38 @@ def do_tail_stack_events(main_stack, num, columns, headers, max_depth, follow):
                 continue
             last_event_timestamp = new_events[-1].timestamp
 
-            update_stacks_from_events(stacks, events, main_stack, max_depth=max_depth)
+            update_stacks_from_events(
+                stacks, events, main_stack, graph, max_depth=max_depth
+            )
 
             # TODO: If an event for a stack comes in that isn't in stacks, add it to stacks.
-            # TODO: Remove a stack from stacks if there is an "end" event? DELETE_COMPLETE or UPDATE_COMPLETE perhaps?
-            #       If adding a stack is implemented this should be fine.
-            update_columns(columns, new_events)
-
-            # TODO: Only output headers if the column width has changed or we've output more than X rows since the last
-            # header.
-            output_events(columns, [headers])
-            output_events(columns, new_events)
+            # TODO: Remove a stack from stacks if there is an "end" event? DELETE_COMPLETE or UPDATE_COMPLETE
+            #       perhaps? If adding a stack is implemented this should be fine.
+            # Headers are only written again if this widens a column or enough rows have gone by.
+            table.widen(new_events)
+            table.write(new_events)
             for event in new_events:
-                # TODO: outputted grows constantly over time, it needs to be culled at some point.
-                # Potential fix: outputted is replaced each time we loop with only the ids from the loop.
-                outputted.add(event.id)
+                outputted.add(event)
         except Exception:
             traceback.print_exc()
 
 
-@retry
-def next_page(pages):
-    try:
-        return list(next(pages))
-    except botocore.exceptions.ClientError:
-        return None
-        # traceback.print_exc()
-    except StopIteration:
-        return None
-
-
-def get_stack_failure_events(stack, columns, headers, start_func=None):
-    pages = stack.events.pages()
+def stack_failure_events_requests(stack_id, start_func=None):
     events = []
     end = False
     ready = start_func is None
     first = True
+    next_token = None
     while not end:
-        page = next_page(pages)
-        # update_columns(columns, page)
-        # output_events(columns, [headers])
-        # output_events(columns, page)
+        try:
+            page, next_token = yield from cloudformation.stack_events_page_requests(
+                stack_id, next_token
+            )
+        except botocore.exceptions.ClientError:
+            # traceback.print_exc()
+            break
         # print(page)
-        # print(stack.stack_id)
+        # print(stack_id)
         if not page:
             break
         for event in page:
@@ -325,7 +409,7 @@ def get_stack_failure_events(stack, columns, headers, start_func=None):
             elif (
                 event.resource_type == STACK_TYPE
                 and event.resource_status.upper().endswith("COMPLETE")
-                and event.physical_resource_id == stack.stack_id
+                and event.physical_resource_id == stack_id
                 and (
                     not first
                     or event.resource_status.upper() != "UPDATE_ROLLBACK_COMPLETE"
@@ -334,21 +418,147 @@ def get_stack_failure_events(stack, columns, headers, start_func=None):
                 end = True
                 break
             first = False
-    # update_columns(columns, events)
-    # output_events(columns, [headers])
-    # output_events(columns, events)
+        if not next_token:
+            break
     events = sorted(
         (event for event in events if "FAIL" in event.resource_status.upper()),
         key=lambda e: e.timestamp,
     )
-    # update_columns(columns, events)
-    # output_events(columns, [headers])
-    # output_events(columns, events)
     return events
 
 
+# A row of the postmortem failure tree. stack is the stack name indented by its depth in the tree.
+FailureRow = collections.namedtuple(
+    "FailureRow",
+    (
+        "timestamp",
+        "stack",
+        "resource_type",
+        "logical_resource_id",
+        "resource_status",
+        "resource_status_reason",
+    ),
+)
+
+ROOT_CAUSE_MARKER = "* "
+
+
+class FailureNode(object):
+    """A stack in the failure tree, with its failure events and a node for each nested stack which failed."""
+
+    def __init__(self, stack_id, start_func=None, depth=0):
+        self.stack_id = stack_id
+        self.start_func = start_func
+        self.depth = depth
+        self.events = []
+        # Maps the id of each failure event for a nested stack which was explored to its node.
+        self.children = {}
+
+    def nested_failures(self):
+        """Return the earliest failure event for each nested stack which failed because something in it failed.
+
+        Nested stacks which only failed because their update was cancelled are left out.
+        """
+        failures = collections.OrderedDict()
+        for event in self.events:
+            if (
+                event.resource_type == STACK_TYPE
+                and event.physical_resource_id
+                and event.physical_resource_id != self.stack_id
+                and "failed to" in (event.resource_status_reason or "").lower()
+                and event.physical_resource_id not in failures
+            ):
+                failures[event.physical_resource_id] = event
+        return list(failures.values())
+
+
+def get_failure_tree(engine, stack_id, start_func=None):
+    """Build the tree of failures in a stack update.
+
+    Each level of the tree is explored concurrently, so it takes one round of event reads per level. A nested stack's
+    events are only read back to the time its parent saw it fail.
+    """
+    root = FailureNode(stack_id, start_func)
+    level = [root]
+    while level:
+        next_level = []
+        for node, events in zip(
+            level,
+            engine.map(
+                lambda node: stack_failure_events_requests(
+                    node.stack_id, start_func=node.start_func
+                ),
+                level,
+            ),
+        ):
+            node.events = events
+            for event in node.nested_failures():
+                child = FailureNode(
+                    event.physical_resource_id,
+                    lambda e, event=event: e.timestamp <= event.timestamp,
+                    node.depth + 1,
+                )
+                node.children[event.id] = child
+                next_level.append(child)
+        level = next_level
+    return root
+
+
+def find_root_cause(node):
+    """Return the earliest failure event in the tree which isn't explained by failures further down.
+
+    A nested stack's failure is only explained by its own failures if any of them could be found.
+    """
+    causes = [
+        event
+        for event in node.events
+        if event.id not in node.children or not node.children[event.id].events
+    ]
+    causes.extend(
+        cause
+        for cause in (find_root_cause(child) for child in node.children.values())
+        if cause is not None
+    )
+    return min(causes, key=lambda e: e.timestamp) if causes else None
+
+
+def failure_rows(node, root_cause, show_all_failures=False):
+    """Yield the rows for a failure tree, with each nested stack's rows right after the event for its failure.
+
+    Unless show_all_failures is set, only each stack's first failure and the failures of its nested stacks are shown.
+    """
+    for i, event in enumerate(node.events):
+        if not (
+            show_all_failures
+            or i == 0
+            or event.id in node.children
+            or event is root_cause
+        ):
+            continue
+        yield FailureRow(
+            event.timestamp,
+            "%s%s%s"
+            % (
+                ROOT_CAUSE_MARKER
+                if event is root_cause
+                else " " * len(ROOT_CAUSE_MARKER),
+                "  " * node.depth,
+                event.stack_name,
+            ),
+            event.resource_type,
+            event.logical_resource_id,
+            event.resource_status,
+            event.resource_status_reason,
+        )
+        if event.id in node.children:
+            for row in failure_rows(
+                node.children[event.id], root_cause, show_all_failures
+            ):
+                yield row
+
+
 def do_postmortem(
-    stack, columns, headers, search_for_failure=False, show_all_failures=False
+    engine, stack, table, search_for_failure=False, show_all_failures=False
 ):
     print("Getting events...")
     start_func = (
@@ -362,98 +572,321 @@ def do_postmortem(
         if search_for_failure
         else None
     )
-    top_level = True
-    events = []
-    while True:
-        new_events = get_stack_failure_events(
-            stack, columns, headers, start_func=start_func
+    tree = get_failure_tree(engine, stack.stack_id, start_func)
+    if not tree.events:
+        print(
+            "The last stack update succeeded or there is an ongoing update which has no failures yet."
+        )
+        sys.exit(1)
+
+    root_cause = find_root_cause(tree)
+    rows = list(failure_rows(tree, root_cause, show_all_failures))
+    table.widen(rows)
+    table.write(rows)
+
+    def empty_nodes(node):
+        for child in node.children.values():
+            if not child.events:
+                yield child
+            for empty in empty_nodes(child):
+                yield empty
+
+    for node in empty_nodes(tree):
+        print("No failure events found in nested stack %r." % (node.stack_id,))
+    if root_cause is None:
+        return
+    print(
+        "%sRoot cause:%s %s %s %s: %s"
+        % (
+            colorama.Style.BRIGHT + colorama.Fore.RED,
+            colorama.Style.RESET_ALL,
+            root_cause.stack_name,
+            root_cause.logical_resource_id,
+            root_cause.resource_status,
+            root_cause.resource_status_reason,
+        )
+    )
+
+
+TIMINGS_TOP = 20
+
+
+class OperationTimeline(object):
+    """The resource spans of the last operation on a stack and on every stack nested in it."""
+
+    def __init__(self, stack_id, events_by_stack, now):
+        self.stack_id = stack_id
+        self.graph = cloudformation.StackGraph(stack_id)
+        self.stack_names = {}
+        self.spans = {}
+        for nested_id, events in events_by_stack.items():
+            for event in events:
+                self.graph.add_event(event)
+                self.stack_names.setdefault(nested_id, event.stack_name)
+            self.spans[nested_id] = cloudformation.resource_spans(events, now)
+        events = events_by_stack.get(stack_id, [])
+        self.start = events[0].timestamp if events else now
+        own_events = [event for event in events if cloudformation.is_own_event(event)]
+        self.end = (
+            own_events[-1].timestamp
+            if own_events and not own_events[-1].resource_status.endswith("IN_PROGRESS")
+            else now
         )
-        if not new_events:
-            if top_level:
-                print(
-                    "The last stack update succeeded or there is an ongoing update which has no failures yet."
+
+    def all_spans(self):
+        return [span for spans in self.spans.values() for span in spans]
+
+    def critical_path(self, stack_id=None, start=None, end=None, depth=0):
+        """Return (depth, span) pairs for the chain of resources which decided how long the operation took.
+
+        CloudFormation doesn't say which resources each one waited for, so working back from the end of the operation
+        each step takes the resource which finished last before the one after it started. A nested stack on the path
+        is followed by the path through it.
+        """
+        stack_id = stack_id or self.stack_id
+        start = start or self.start
+        end = end or self.end
+        path = []
+        while True:
+            candidates = [
+                span
+                for span in self.spans.get(stack_id, [])
+                if span.end <= end and start <= span.start < end
+            ]
+            if not candidates:
+                return path
+            span = max(candidates, key=lambda s: (s.end, s.end - s.start))
+            nested = []
+            if (
+                span.resource_type == STACK_TYPE
+                and span.physical_resource_id in self.spans
+            ):
+                nested = self.critical_path(
+                    span.physical_resource_id, span.start, span.end, depth + 1
                 )
-                sys.exit(1)
-            else:
-                print("No failure events found in nested stack %r." % (stack,))
-                break
-        if not show_all_failures:
-            new_events = [new_events[0]]
-        events.extend(new_events)
-        fail_event = new_events[0]
-        if (
-            fail_event.resource_type != STACK_TYPE
-            or "failed to" not in fail_event.resource_status_reason.lower()
-        ):
-            break
-        start_func = lambda event: event.timestamp <= fail_event.timestamp
-        stack = get_stack(fail_event.physical_resource_id)
+            path[0:0] = [(depth, span)] + nested
+            end = span.start
+
+    def chrome_trace(self, critical=()):
+        """Return the timeline in the Chrome trace event format, with a thread for each stack, parents first."""
+        trace_events = []
+        critical = set(critical)
+        for tid, stack_id in enumerate(self.graph.subtree(self.stack_id), 1):
+            depth = self.graph.depth(stack_id) or 0
+            name = "%s%s" % ("  " * depth, self.stack_names.get(stack_id, stack_id))
+            trace_events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+            trace_events.append(
+                {
+                    "name": "thread_sort_index",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"sort_index": tid},
+                }
+            )
+            for span in self.spans.get(stack_id, []):
+                trace_events.append(
+                    {
+                        "name": span.logical_resource_id,
+                        "cat": span.resource_type,
+                        "ph": "X",
+                        "pid": 1,
+                        "tid": tid,
+                        "ts": microseconds(span.start - self.start),
+                        "dur": microseconds(span.end - span.start),
+                        "args": {
+                            "status": span.resource_status,
+                            "physical_resource_id": span.physical_resource_id,
+                            "critical_path": span in critical,
+                        },
+                    }
+                )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def microseconds(delta):
+    return int(delta.total_seconds() * 1000000)
 
-    events.sort(key=lambda e: e.timestamp, reverse=show_all_failures)
-    update_columns(columns, events)
-    output_events(columns, [headers])
-    output_events(columns, events)
+
+def get_operation_timeline(engine, stack_id):
+    """Read the events of the last operation on a stack and every stack nested in it, concurrently."""
+    events_by_stack = {}
+
+    def nested_stacks(item, events):
+        since = (
+            item[1]
+            if item[1] is not None
+            else (events[0].timestamp if events else None)
+        )
+        if since is None:
+            return []
+        nested_ids = collections.OrderedDict()
+        for event in events:
+            if (
+                event.resource_type == STACK_TYPE
+                and event.physical_resource_id
+                and not cloudformation.is_own_event(event)
+                and event.physical_resource_id not in events_by_stack
+            ):
+                nested_ids[event.physical_resource_id] = None
+        return [(nested_id, since) for nested_id in nested_ids]
+
+    for (nested_id, _), events in engine.traverse(
+        lambda item: cloudformation.operation_events_requests(*item),
+        [(stack_id, None)],
+        nested_stacks,
+    ):
+        events_by_stack[nested_id] = events
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return OperationTimeline(stack_id, events_by_stack, now)
+
+
+# A row of the timings tables. stack is the stack name, indented by depth on the critical path.
+TimingRow = collections.namedtuple(
+    "TimingRow",
+    (
+        "offset",
+        "duration",
+        "stack",
+        "resource_type",
+        "logical_resource_id",
+        "resource_status",
+    ),
+)
+
+
+def timing_row(timeline, span, depth=0):
+    return TimingRow(
+        "+%s" % (durations.format_duration(span.start - timeline.start),),
+        durations.format_duration(span.end - span.start),
+        "%s%s" % ("  " * depth, span.stack_name),
+        span.resource_type,
+        span.logical_resource_id,
+        span.resource_status,
+    )
+
+
+def do_timings(engine, stack, table, top=TIMINGS_TOP, trace_file=None, model=None):
+    print("Getting events...")
+    timeline = get_operation_timeline(engine, stack.stack_id)
+    spans = timeline.all_spans()
+    if model is not None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        model.learn(spans, now)
+        model.save(now)
+    if not spans:
+        print("No resources changed in the last operation on the stack.")
+        sys.exit(1)
+
+    print(
+        "%sSlowest resources%s (the operation took %s across %d stacks):"
+        % (
+            colorama.Style.BRIGHT,
+            colorama.Style.RESET_ALL,
+            durations.format_duration(timeline.end - timeline.start),
+            len(timeline.spans),
+        )
+    )
+    slowest = sorted(spans, key=lambda s: s.end - s.start, reverse=True)[:top]
+    path = timeline.critical_path()
+    rows = [timing_row(timeline, span) for span in slowest]
+    path_rows = [timing_row(timeline, span, depth) for depth, span in path]
+    table.widen(rows + path_rows)
+    table.write(rows, headers=True)
+
+    print("\n%sCritical path:%s" % (colorama.Style.BRIGHT, colorama.Style.RESET_ALL))
+    table.write(path_rows, headers=True)
+
+    if trace_file:
+        with open(trace_file, "w") as f:
+            json.dump(timeline.chrome_trace(span for _, span in path), f)
+        print("Wrote the timeline to %s" % (trace_file,))
 
 
 def main():
     args = docopt.docopt(__doc__)
-    if args["--profile"]:
-        boto3.setup_default_session(profile_name=args["--profile"])
     postmortem = args["--postmortem"]
+    timings = args["--timings"]
 
     max_column_length = args["--max-column-length"]
     if max_column_length is None:
         max_column_length = 200 if postmortem else 40
     max_column_length = int(max_column_length)
 
-    columns = collections.OrderedDict(
-        [
-            ("timestamp", Column(0, max_column_length)),
-            ("stack_name", Column(0, max_column_length)),
-            # ('stack_id', Column(0, max_column_length)),
-            ("resource_type", Column(0, max_column_length)),
-            ("logical_resource_id", Column(0, max_column_length)),
-            # ('physical_resource_id', Column(0, max_column_length)),
-            ("resource_status", Column(0, max_column_length)),
-            ("resource_status_reason", Column(0, max_column_length)),
+    if timings:
+        columns = [
+            ("offset", "Start"),
+            ("duration", "Duration"),
+            # The critical path shows the stacks as a tree.
+            ("stack", "Stack"),
+            ("resource_type", "Resource Type"),
+            ("logical_resource_id", "Logical Resource ID"),
+            ("resource_status", "Status"),
         ]
-    )
-    headers = collections.namedtuple("Headers", columns.keys())(
-        *[
-            colorama.Style.BRIGHT + t + colorama.Style.RESET_ALL
-            for t in [
-                "Timestamp",
-                "Stack Name",
-                # 'Stack ID',
-                "Resource Type",
-                "Logical Resource ID",
-                # 'Physical Resource ID',
-                "Status",
-                "Reason",
-            ]
-        ]
-    )
-    update_columns(columns, [headers])
-
-    print("Getting stack...")
-    main_stack = get_stack(args["<stack>"])
-
-    if postmortem:
-        do_postmortem(
-            main_stack,
-            columns,
-            headers,
-            search_for_failure=args["--find-last-failure"],
-            show_all_failures=args["--show-all-failures"],
-        )
     else:
-        num = int(args["--number"])
-        max_depth = int(args["--depth"])
-        if max_depth == -1:
-            max_depth = None
-        do_tail_stack_events(
-            main_stack, num, columns, headers, max_depth, args["--follow"]
-        )
+        columns = [
+            ("timestamp", "Timestamp"),
+            # The postmortem shows the stacks as a tree.
+            ("stack", "Stack") if postmortem else ("stack_name", "Stack Name"),
+            # ("stack_id", "Stack ID"),
+            ("resource_type", "Resource Type"),
+            ("logical_resource_id", "Logical Resource ID"),
+            # ("physical_resource_id", "Physical Resource ID"),
+            ("resource_status", "Status"),
+            ("resource_status_reason", "Reason"),
+        ]
+    table = tables.Table(columns, max_column_length, left_aligned=("stack",))
+
+    metrics.setup(args["--prometheus-file"])
+    engine = clients.get_engine("cloudformation", args["--asyncio"], args["--profile"])
+    try:
+        print("Getting stack...")
+        main_stack = engine.run(cloudformation.describe_stack_requests(args["<stack>"]))
+
+        if postmortem or timings:
+            if postmortem:
+                do_postmortem(
+                    engine,
+                    main_stack,
+                    table,
+                    search_for_failure=args["--find-last-failure"],
+                    show_all_failures=args["--show-all-failures"],
+                )
+            else:
+                do_timings(
+                    engine,
+                    main_stack,
+                    table,
+                    top=int(args["--top"]),
+                    trace_file=args["--trace-file"],
+                    model=durations.DurationModel(args["--durations-file"]),
+                )
+        else:
+            num = int(args["--number"])
+            max_depth = int(args["--depth"])
+            if max_depth == -1:
+                max_depth = None
+            do_tail_stack_events(
+                engine,
+                main_stack,
+                num,
+                table,
+                max_depth,
+                args["--follow"],
+                args["--stats"],
+            )
+    finally:
+        engine.close()
+        if args["--stats"]:
+            print_stats(engine, table)
 
 
 if __name__ == "__main__":
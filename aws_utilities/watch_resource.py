@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 """Usage:
-    watch_resource.py [--profile=<p>] <arn>...
+    watch_resource.py [--profile=<p>] [--stats] [--prometheus-file=<path>] <arn>...
+
+Options:
+    --stats                     Print the calls, retries, throttles, bytes and latency of each API operation on exit.
+    --prometheus-file=<path>    Keep the API metrics in this file in the Prometheus text format.
 """
 import collections
 import time
 
-import boto3
 import docopt
 
+from aws_utilities import clients
+from aws_utilities import metrics
+
 
 class Error(Exception):
     pass
@@ -29,22 +35,22 @@ DESCRIPTORS = [
     Descriptor(
         "rds",
         "db",
-        lambda arn: boto3.client("rds").describe_db_instances(DBInstanceIdentifier=arn),
+        lambda client, arn: client.describe_db_instances(DBInstanceIdentifier=arn),
         "DBInstances",
         "DBInstanceStatus",
-        lambda arn: boto3.client("rds").describe_db_instances(DBInstanceIdentifier=arn)[
+        lambda client, arn: client.describe_db_instances(DBInstanceIdentifier=arn)[
             "DBInstances"
         ][0]["DBInstanceStatus"],
     ),
     Descriptor(
         "ec2",
         "volume",
-        lambda arn: boto3.client("ec2").describe_volumes(
+        lambda client, arn: client.describe_volumes(
             VolumeIds=[arn.split(":")[-1].split("/")[-1]]
         ),
         "Volumes",
         "State",
-        lambda arn: boto3.client("ec2").describe_volumes(
+        lambda client, arn: client.describe_volumes(
             VolumeIds=[arn.split(":")[-1].split("/")[-1]]
         )["Volumes"][0]["State"],
     ),
@@ -60,8 +66,7 @@ for _ in DESCRIPTORS:
 
 def main():
     args = docopt.docopt(__doc__)
-    if args["--profile"]:
-        boto3.setup_default_session(profile_name=args["--profile"])
+    metrics.setup(args["--prometheus-file"])
     arn_strs = args["<arn>"]
     descriptors = []
     for arn_str in arn_strs:
@@ -79,11 +84,15 @@ def main():
     try:
         while True:
             for descriptor in descriptors:
-                status = descriptor.status_func(arn_str)
+                client = clients.get_client(descriptor.service, args["--profile"])
+                status = descriptor.status_func(client, arn_str)
                 print(arn_str, status)
             time.sleep(5)
     except KeyboardInterrupt:
         pass
+    finally:
+        if args["--stats"]:
+            metrics.print_stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,48 @@
+from aws_utilities import cloudformation
+
+
+def test_stack_graph_depths_and_ancestors():
+    graph = cloudformation.StackGraph("root")
+    graph.add("child", "root")
+    graph.add("grandchild", "child")
+
+    assert graph.depth("grandchild") == 2
+    assert graph.ancestors("grandchild") == ["child", "root"]
+    assert graph.within("grandchild", 2)
+    assert not graph.within("grandchild", 1)
+    assert graph.within("grandchild", None)
+
+
+def test_stack_graph_attaches_stacks_added_before_their_parent():
+    graph = cloudformation.StackGraph("root")
+    graph.add("grandchild", "child")
+
+    assert graph.depth("grandchild") is None
+    assert "grandchild" not in graph
+
+    graph.add("child", "root")
+
+    assert graph.depth("grandchild") == 2
+    assert graph.subtree("root") == ["root", "child", "grandchild"]
+
+
+def test_stack_graph_moves_a_stack_to_its_new_parent():
+    graph = cloudformation.StackGraph("root")
+    graph.add("a", "root")
+    graph.add("b", "a")
+    graph.add("c", "b")
+    graph.add("c", "a")
+
+    assert graph.depth("c") == 2
+    assert graph.subtree("b") == ["b"]
+    assert sorted(graph.subtree("a")) == ["a", "b", "c"]
+
+
+def test_stack_graph_ignores_the_root_and_missing_ids():
+    graph = cloudformation.StackGraph("root")
+    graph.add("root", "other")
+    graph.add("", "root")
+    graph.add("child", None)
+
+    assert len(graph) == 1
+    assert graph.depth("root") == 0
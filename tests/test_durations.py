@@ -0,0 +1,79 @@
+import datetime
+
+from aws_utilities import cloudformation
+from aws_utilities import durations
+
+
+def test_histogram_quantiles_are_within_a_bucket():
+    histogram = durations.Histogram()
+    for seconds in range(1, 101):
+        histogram.add(seconds)
+
+    assert histogram.samples == 100
+    assert 50 / durations.GROWTH <= histogram.quantile(0.5) <= 50 * durations.GROWTH
+    assert 95 / durations.GROWTH <= histogram.quantile(0.95) <= 95 * durations.GROWTH
+
+
+def test_histogram_halves_its_counts_when_full():
+    histogram = durations.Histogram()
+    for _ in range(durations.MAX_SAMPLES + 1):
+        histogram.add(10)
+
+    assert histogram.samples == (durations.MAX_SAMPLES + 1) / 2.0
+
+
+def test_histogram_round_trips_through_json():
+    histogram = durations.Histogram()
+    for seconds in (5, 50, 500):
+        histogram.add(seconds)
+
+    loaded = durations.Histogram(histogram.to_json()["buckets"])
+
+    assert loaded.counts == histogram.counts
+
+
+def span(end, seconds, logical_resource_id="Queue"):
+    return cloudformation.ResourceSpan(
+        "stack",
+        "name",
+        logical_resource_id,
+        "physical",
+        "AWS::SQS::Queue",
+        "CREATE_COMPLETE",
+        end - datetime.timedelta(seconds=seconds),
+        end,
+    )
+
+
+def test_model_learns_saves_and_estimates(tmp_path):
+    path = str(tmp_path / "durations.json")
+    now = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    model = durations.DurationModel(path)
+    model.learn([span(now - datetime.timedelta(minutes=i), 60) for i in range(5)], now)
+    model.save(now)
+
+    estimate = durations.DurationModel(path).estimate(
+        "CREATE_IN_PROGRESS", "AWS::SQS::Queue", "Other"
+    )
+
+    assert estimate.samples == 5
+    assert (
+        60 / durations.GROWTH <= estimate.p50.total_seconds() <= 60 * durations.GROWTH
+    )
+
+
+def test_model_doesnt_learn_the_same_change_twice(tmp_path):
+    path = str(tmp_path / "durations.json")
+    now = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    spans = [span(now - datetime.timedelta(minutes=i), 60) for i in range(3)]
+    for _ in range(2):
+        model = durations.DurationModel(path)
+        model.learn(spans, now)
+        model.save(now)
+
+    assert (
+        durations.DurationModel(path)
+        .estimate("CREATE_IN_PROGRESS", "AWS::SQS::Queue", "Queue")
+        .samples
+        == 3
+    )
@@ -0,0 +1,84 @@
+import boto3.session
+import botocore.exceptions
+import botocore.stub
+import pytest
+
+from aws_utilities import concurrency
+from aws_utilities import tail_cloudwatch_logs
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(tail_cloudwatch_logs, "QUERY_MIN_INTERVAL", 0)
+    client = boto3.session.Session(
+        aws_access_key_id="key", aws_secret_access_key="secret", region_name="us-east-1"
+    ).client("logs")
+    with botocore.stub.Stubber(client) as stubber:
+        yield concurrency.EventletEngine(client), stubber
+        stubber.assert_no_pending_responses()
+
+
+def start(stubber, query_id, query_string):
+    stubber.add_response(
+        "start_query",
+        {"queryId": query_id},
+        {
+            "logGroupNames": ["group"],
+            "startTime": 1,
+            "endTime": 2,
+            "queryString": query_string,
+        },
+    )
+
+
+def results(stubber, query_id, status, rows):
+    stubber.add_response(
+        "get_query_results",
+        {
+            "status": status,
+            "results": [
+                [{"field": field, "value": value} for field, value in row]
+                for row in rows
+            ],
+        },
+        {"queryId": query_id},
+    )
+
+
+def test_event_rows_are_printed_as_they_arrive(engine, capsys):
+    engine, stubber = engine
+    start(stubber, "q", "fields @message")
+    results(stubber, "q", "Running", [[("@message", "one"), ("@ptr", "1")]])
+    results(
+        stubber,
+        "q",
+        "Complete",
+        [[("@message", "one"), ("@ptr", "1")], [("@message", "two"), ("@ptr", "2")]],
+    )
+
+    tail_cloudwatch_logs.run_queries(engine, ["fields @message"], ["group"], 1000, 2000)
+
+    assert capsys.readouterr().out == "@message=one\n@message=two\n"
+
+
+def test_aggregate_rows_wait_for_the_query_to_complete(engine, capsys):
+    engine, stubber = engine
+    start(stubber, "q", "stats count()")
+    results(stubber, "q", "Running", [[("count()", "3")]])
+    results(stubber, "q", "Complete", [[("count()", "5")]])
+
+    tail_cloudwatch_logs.run_queries(engine, ["stats count()"], ["group"], 1000, 2000)
+
+    assert capsys.readouterr().out == "count()=5\n"
+
+
+def test_queries_which_started_are_stopped_when_one_fails(engine, capsys):
+    engine, stubber = engine
+    start(stubber, "a", "fields a")
+    stubber.add_client_error("start_query", "MalformedQueryException")
+    stubber.add_response("stop_query", {"success": True}, {"queryId": "a"})
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        tail_cloudwatch_logs.run_queries(
+            engine, ["fields a", "fields b"], ["group"], 1000, 2000
+        )
@@ -0,0 +1,156 @@
+import pytest
+
+from aws_utilities import concurrency
+from aws_utilities import log_cache
+
+
+def event(timestamp, stream="stream", size=10):
+    return {
+        "eventId": "%s-%d" % (stream, timestamp),
+        "timestamp": timestamp,
+        "ingestionTime": timestamp,
+        "logStreamName": stream,
+        "message": "x" * size,
+    }
+
+
+def read_all(store, start, end):
+    return [
+        e["eventId"]
+        for piece_start, piece_end, segment in store.plan(start, end)
+        if segment is not None
+        for e in store.read(segment, piece_start, piece_end)
+    ]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return log_cache.SegmentStore(str(tmp_path / "group"), "group")
+
+
+def test_plan_splits_a_range_into_segments_and_gaps(store):
+    store.append(10, 19, [event(15)])
+    store.append(30, 39, [event(35)])
+
+    plan = [
+        (start, end, segment and segment["start"])
+        for start, end, segment in store.plan(0, 49)
+    ]
+
+    assert plan == [
+        (0, 9, None),
+        (10, 19, 10),
+        (20, 29, None),
+        (30, 39, 30),
+        (40, 49, None),
+    ]
+
+
+def test_appends_to_the_previous_segment_when_contiguous(store):
+    store.append(0, 9, [event(5)])
+    store.append(10, 19, [event(15)])
+
+    assert len(store.segments) == 1
+    assert read_all(store, 0, 19) == ["stream-5", "stream-15"]
+
+
+def test_read_only_returns_events_in_range(store):
+    store.append(0, 99, [event(t) for t in range(0, 100, 10)])
+
+    assert read_all(store, 25, 55) == ["stream-30", "stream-40", "stream-50"]
+    assert read_all(store, 25, 26) == []
+
+
+def test_read_filters_streams(store):
+    store.append(0, 9, [event(1, "a"), event(2, "b")])
+
+    assert [e["eventId"] for e in store.read(store.segments[0], 0, 9, {"b"})] == ["b-2"]
+    assert list(store.read(store.segments[0], 0, 9, {"c"})) == []
+
+
+def test_segments_are_capped_between_timestamps(store, monkeypatch):
+    monkeypatch.setattr(log_cache, "SEGMENT_BYTES", 2000)
+    monkeypatch.setattr(log_cache, "OFFSET_INDEX_BYTES", 300)
+    # Pairs of events share a timestamp, so a cut can only fall between pairs.
+    events = [event(t // 2, "s%d" % (t % 2), 100) for t in range(200)]
+
+    store.append(0, 99, events)
+    reloaded = log_cache.SegmentStore(store.path, "group")
+
+    assert len(reloaded.segments) > 1
+    for segment, following in zip(reloaded.segments, reloaded.segments[1:]):
+        assert segment["end"] + 1 == following["start"]
+        assert segment["bytes"] <= log_cache.SEGMENT_BYTES
+    assert all(segment["offsets"] for segment in reloaded.segments)
+    for start, end in ((0, 99), (17, 17), (40, 73), (98, 200)):
+        assert sorted(read_all(reloaded, start, end)) == sorted(
+            e["eventId"] for e in events if start <= e["timestamp"] <= end
+        )
+
+
+def test_segments_without_offsets_are_read_from_the_start(store):
+    store.append(0, 99, [event(t) for t in range(100)])
+    del store.segments[0]["offsets"]
+
+    assert len(read_all(store, 50, 52)) == 3
+
+
+def test_events_requests_fetches_only_the_gaps(tmp_path):
+    cache = log_cache.LogCache(str(tmp_path))
+    cache.store("group").append(10, 19, [event(15)])
+    fetched = []
+
+    def fetch_requests(log_group, start, end):
+        response = yield "fetch", {"start": start, "end": end}
+        return response
+
+    def call(operation, start, end):
+        fetched.append((start, end))
+        return [event(t) for t in range(start, end + 1, 5)]
+
+    events = concurrency.run_requests(
+        cache.events_requests(fetch_requests, "group", 0, 29), call
+    )
+
+    assert fetched == [(0, 9), (20, 29)]
+    assert [e["timestamp"] for e in events] == [0, 5, 15, 20, 25]
+    assert cache.covers("group", 0, 29)
+
+
+def test_events_requests_offline_skips_the_gaps(tmp_path):
+    cache = log_cache.LogCache(str(tmp_path))
+    cache.store("group").append(10, 19, [event(15)])
+
+    def fetch_requests(log_group, start, end):
+        raise AssertionError("fetched while offline")
+        yield
+
+    events = concurrency.run_requests(
+        cache.events_requests(fetch_requests, "group", 0, 29, offline=True), None
+    )
+
+    assert [e["timestamp"] for e in events] == [15]
+
+
+def test_add_only_caches_what_isnt_cached(tmp_path):
+    cache = log_cache.LogCache(str(tmp_path))
+    cache.store("group").append(10, 19, [event(15)])
+
+    cache.add("group", 0, 29, [event(5), event(16), event(25)])
+
+    store = cache.store("group")
+    assert [(s["start"], s["end"]) for s in store.segments] == [(0, 9), (10, 29)]
+    assert read_all(store, 0, 29) == ["stream-5", "stream-15", "stream-25"]
+
+
+def test_evict_removes_the_least_recently_read_segments(tmp_path):
+    cache = log_cache.LogCache(str(tmp_path), max_bytes=1)
+    store = cache.store("group")
+    store.append(0, 9, [event(5)])
+    store.append(20, 29, [event(25)])
+    store.segments[1]["accessed"] = store.segments[0]["accessed"] + 1
+    cache.max_bytes = store.segments[1]["bytes"]
+
+    cache.evict()
+
+    assert [s["start"] for s in store.segments] == [20]
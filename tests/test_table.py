@@ -0,0 +1,22 @@
+import colorama
+
+from aws_utilities import table
+
+
+def visible(line):
+    return table.ANSI_ESCAPE.sub("", line)
+
+
+def test_clip_leaves_short_lines_alone():
+    line = "short %sline%s\n" % (colorama.Fore.RED, colorama.Style.RESET_ALL)
+
+    assert table.clip(line, 20) == line
+
+
+def test_clip_ignores_color_codes_when_measuring():
+    line = "ab  %sSTATUS%s  reason\n" % (colorama.Fore.RED, colorama.Style.RESET_ALL)
+
+    clipped = table.clip(line, 8)
+
+    assert visible(clipped) == "ab  STA%s\n" % (table.ELLIPSIS,)
+    assert clipped.endswith(colorama.Style.RESET_ALL + "\n")
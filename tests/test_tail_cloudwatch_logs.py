@@ -0,0 +1,134 @@
+import pytest
+
+from aws_utilities import concurrency
+from aws_utilities import tail_cloudwatch_logs
+
+
+class FakeLogs(object):
+    """Serves FilterLogEvents from a list of events, a page of page_size events at a time."""
+
+    def __init__(self, timestamps, page_size=10):
+        self.events = [
+            {
+                "eventId": str(i),
+                "timestamp": timestamp,
+                "logStreamName": "stream",
+                "message": "m%d" % (i,),
+            }
+            for i, timestamp in enumerate(timestamps)
+        ]
+        self.page_size = page_size
+        self.calls = 0
+
+    def __call__(
+        self, operation, logGroupName, startTime, endTime=None, nextToken=None, **kwargs
+    ):
+        assert operation == "filter_log_events"
+        self.calls += 1
+        events = [
+            dict(e)
+            for e in self.events
+            if startTime <= e["timestamp"]
+            and (endTime is None or e["timestamp"] <= endTime)
+        ]
+        offset = int(nextToken or 0)
+        response = {"events": events[offset : offset + self.page_size]}
+        if offset + self.page_size < len(events):
+            response["nextToken"] = str(offset + self.page_size)
+        return response
+
+
+def test_adaptive_interval_shrinks_with_events_and_grows_when_idle():
+    interval = tail_cloudwatch_logs.AdaptiveInterval(1, 8)
+    interval.update(0)
+    interval.update(0)
+    assert interval.current == 4
+
+    interval.update(5)
+    assert interval.current == 2
+
+    interval.throttled()
+    interval.update(5)
+    assert interval.current == 8
+
+    interval.update(0)
+    assert interval.current == 8
+    assert interval.polls == 5
+    assert interval.events == 10
+    assert interval.throttles == 1
+
+
+def test_event_id_cache_forgets_the_least_recently_seen():
+    seen = tail_cloudwatch_logs.EventIdCache(max_size=2)
+    assert seen.add("a")
+    assert seen.add("b")
+    assert not seen.add("a")
+    assert seen.add("c")
+
+    assert "a" in seen
+    assert "b" not in seen
+
+
+def test_event_id_digests_get_log_events_messages():
+    event = {
+        "log_group": "group",
+        "log_stream": "stream",
+        "timestamp": 1,
+        "ingestionTime": 2,
+        "message": "x" * 100000,
+    }
+
+    key = tail_cloudwatch_logs.event_id(event)
+
+    assert len(repr(key)) < 200
+    assert key != tail_cloudwatch_logs.event_id(dict(event, message="y"))
+
+
+@pytest.mark.parametrize("parts", [1, 3, 4, 7])
+def test_split_range_covers_the_range(parts):
+    ranges = tail_cloudwatch_logs.split_range(10, 109, parts)
+
+    assert len(ranges) == parts
+    assert ranges[0][0] == 10
+    assert ranges[-1][1] == 109
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end + 1 == start
+
+
+def test_last_range_events_reads_the_newest_part_of_a_busy_range_first():
+    # Thousands of events early on and a few at the end of the range.
+    logs = FakeLogs(list(range(5000)) + [99990, 99995, 99999], page_size=100)
+
+    events = concurrency.run_requests(
+        tail_cloudwatch_logs.last_range_events_requests("group", 0, 99999, 5), logs,
+    )
+
+    assert [e["timestamp"] for e in events] == [4998, 4999, 99990, 99995, 99999]
+    # Paging through the whole range would take 51 calls.
+    assert logs.calls < 25
+
+
+def test_group_cursor_looks_back_for_late_events():
+    logs = FakeLogs([1000, 2000])
+    cursor = tail_cloudwatch_logs.GroupCursor("group", 0)
+    seen = tail_cloudwatch_logs.EventIdCache()
+
+    def read():
+        return [
+            e["message"]
+            for e in concurrency.run_requests(
+                tail_cloudwatch_logs.read_cursor_requests(cursor, 10, seen), logs
+            )
+        ]
+
+    assert read() == ["m0", "m1"]
+    logs.events.append(
+        {
+            "eventId": "late",
+            "timestamp": 1500,
+            "logStreamName": "other",
+            "message": "late",
+        }
+    )
+    assert read() == ["late"]
+    assert read() == []